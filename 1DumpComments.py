@@ -1,29 +1,178 @@
 """
-This script will dump all comments fields from intercepted HTML response.
+This script will dump all comments fields from intercepted HTML response: HTML comments,
+and `/* */` and `//` comments of inline scripts (and of javascript responses).
 
-Note: no deflate/gzip decompression is performed here
+The response is scanned as it comes, fragment after fragment, in a single pass: comments
+spanning several fragments are found as well. Scripts and pages served again with the same
+content are only scanned the first time, the pimp result cache keeps their comments.
+
+Note: chunked and deflate/gzip encoded bodies are decoded by the pimp shared streams (once
+for all the analysis plugins), and the comments are reported through the pimp findings sink
 """
 
 __PLUGIN__ = "DumpComments"
 __AUTHOR__ = "@_hugsy_"
 
+import re
+from pimp import decoded_streams, MemoStream, RESPONSE, findings
+
+HTML, HTML_COMMENT, SCRIPT, JS_BLOCK, JS_LINE, JS_STRING = range(6)
+
+HTML_TOKEN   = re.compile(r"<!--|<script\b[^>]*>", re.IGNORECASE)
+SCRIPT_TOKEN = re.compile(r"/\*|//|['\"`]|</script\s*>", re.IGNORECASE)
+BLOCK_END    = re.compile(r"\*/|</script\s*>", re.IGNORECASE)
+LINE_END     = re.compile(r"\n|</script\s*>", re.IGNORECASE)
+STRING_END   = {
+    "'": re.compile(r"\\[\s\S]|\\$|'|\n|</script\s*>", re.IGNORECASE),
+    '"': re.compile(r'\\[\s\S]|\\$|"|\n|</script\s*>', re.IGNORECASE),
+    "`": re.compile(r"\\[\s\S]|\\$|`|</script\s*>", re.IGNORECASE),
+}
+
+# longest token that may be cut between two fragments
+MAX_TAG = 1024
+MAX_END_TAG = 16
+MAX_COMMENT = 64*1024
+
+
+class CommentScanner:
+    """
+    Finds the comments of a document given in several pieces. Every piece is only looked at
+    once (besides the few bytes of a token cut at its end, carried over to the next one) and
+    is never sliced but to extract a comment.
+    """
+    def __init__(self, mode=HTML):
+        self.mode = mode
+        self.script = mode == SCRIPT
+        self.tail = ""
+        self.quote = None
+        self.comment = []
+        self.size = 0
+        return
+
+    def feed(self, data):
+        """
+        Scan the next piece of the document, returns the list of comments completed in it.
+        """
+        text = self.tail + data if self.tail else data
+        self.tail = ""
+        found = []
+        pos, n = 0, len(text)
+
+        while pos < n:
+            if self.mode == HTML:
+                m = HTML_TOKEN.search(text, pos)
+                if m is None:
+                    i = text.rfind("<", max(pos, n - MAX_TAG))
+                    if i != -1:
+                        self.tail = text[i:]
+                    break
+                self.mode = HTML_COMMENT if m.group() == "<!--" else SCRIPT
+                pos = m.end()
+
+            elif self.mode == HTML_COMMENT:
+                i = text.find("-->", pos)
+                if i == -1:
+                    self.carry(text, pos, n, 2)
+                    break
+                self.add(text, pos, i)
+                found.append("<!--%s-->" % self.flush())
+                self.mode = HTML
+                pos = i + 3
+
+            elif self.mode == SCRIPT:
+                m = SCRIPT_TOKEN.search(text, pos)
+                if m is None:
+                    self.tail = text[max(pos, n - MAX_END_TAG):]
+                    break
+                token = m.group()
+                if token == "/*":
+                    self.mode = JS_BLOCK
+                elif token == "//":
+                    self.mode = JS_LINE
+                elif token in STRING_END:
+                    self.mode, self.quote = JS_STRING, token
+                else:
+                    self.mode = HTML
+                pos = m.end()
+
+            elif self.mode in (JS_BLOCK, JS_LINE):
+                m = (BLOCK_END if self.mode == JS_BLOCK else LINE_END).search(text, pos)
+                if m is None:
+                    self.carry(text, pos, n, MAX_END_TAG)
+                    break
+                self.add(text, pos, m.start())
+                if self.mode == JS_BLOCK:
+                    found.append("/*%s*/" % self.flush())
+                else:
+                    found.append("//%s" % self.flush().rstrip("\r"))
+                self.mode = SCRIPT if m.group() in ("*/", "\n") else self.leave_script()
+                pos = m.end()
+
+            else:
+                m = STRING_END[self.quote].search(text, pos)
+                if m is None:
+                    self.tail = text[max(pos, n - MAX_END_TAG):]
+                    break
+                token = m.group()
+                if token == "\\":
+                    self.tail = token
+                    break
+                if not token.startswith("\\"):
+                    self.mode = SCRIPT if token in (self.quote, "\n") else self.leave_script()
+                pos = m.end()
+
+        return found
+
+    def close(self):
+        # an unterminated comment is not reported
+        return []
+
+    def leave_script(self):
+        # a javascript document has no end tag to wait for
+        return SCRIPT if self.script else HTML
+
+    def carry(self, text, pos, n, keep):
+        """
+        Keep the comment found so far, but the last `keep` bytes (which may be the beginning
+        of the end tag) that are scanned again with the next piece.
+        """
+        end = max(pos, n - keep)
+        self.add(text, pos, end)
+        self.tail = text[end:]
+        return
+
+    def add(self, text, start, end):
+        if self.size < MAX_COMMENT and end > start:
+            end = min(end, start + MAX_COMMENT - self.size)
+            self.comment.append(text[start:end])
+            self.size += end - start
+        return
+
+    def flush(self):
+        comment = "".join(self.comment)
+        self.comment, self.size = [], 0
+        return comment
+
+
 def proxenet_request_hook(rid, request, uri):
     return request
 
 def proxenet_response_hook(rid, response, uri):
-    comment_start_tag, comment_end_tag = ("<!--", "-->")
-    off = 0
-    while True:
-        i = response[off:].find(comment_start_tag)
-        if i == -1:
-            break
-
-        n = response[off+i:].find(comment_end_tag)
-        if n==-1:
-            off += i + len(comment_start_tag)
-            break
-
-        print "Found comment in %d: %s" % (rid, response[off+i:off+i+n+3])
-        off = off+i+n
+    stream, body = decoded_streams.feed(rid, RESPONSE, response)
+    state = stream.states.get(__PLUGIN__, None)
+    if state is None:
+        if stream.message is not None:
+            ctype = stream.message.get_header("Content-Type") or ""
+            mode = SCRIPT if "script" in ctype.lower() else HTML
+        elif stream.error is not None:
+            mode = HTML
+        else:
+            return response
+        state = MemoStream("%s/%d" % (__PLUGIN__, mode), lambda: CommentScanner(mode), bounded=stream.bounded)
+        stream.states[__PLUGIN__] = state
+
+    if body or stream.complete:
+        for comment in state.feed(body, stream.complete):
+            findings.report(__PLUGIN__, rid, uri, "comment", comment)
 
     return response
@@ -1,20 +1,67 @@
 """
 This script will dump all emails in intercepted HTML response.
 
-Note: no deflate/gzip decompression is performed here
+The responses are scanned fragment after fragment with the pimp Scanner, so addresses
+split between two fragments are found as well. Each address is only reported once per
+host (the addresses seen are kept for the `MAX_HOSTS` most recent hosts, up to
+`MAX_EMAILS_PER_HOST` each). A body already scanned (same content, e.g. a static page
+served again) is not scanned again, its addresses come from the pimp result cache.
+
+Note: chunked and deflate/gzip encoded bodies are decoded by the pimp shared streams (once
+for all the analysis plugins), and the addresses are reported through the pimp findings sink
 """
 
 __PLUGIN__ = "DumpEmails"
 __AUTHOR__ = "@_hugsy_"
 
-import re
+import collections, urlparse
+from pimp import decoded_streams, Scanner, MemoStream, RESPONSE, findings
+
+MAX_HOSTS = 1024
+MAX_EMAILS_PER_HOST = 4096
+
+scanner = Scanner(["email"])
+reported = collections.OrderedDict()
+
+
+def is_new(host, email):
+    """
+    Returns True the first time `email` is seen on `host`, and remembers it.
+    """
+    seen = reported.pop(host, None)
+    if seen is None:
+        seen = collections.OrderedDict()
+    reported[host] = seen
+    if len(reported) > MAX_HOSTS:
+        reported.popitem(last=False)
+
+    email = email.lower()
+    if email in seen:
+        return False
+    seen[email] = True
+    if len(seen) > MAX_EMAILS_PER_HOST:
+        seen.popitem(last=False)
+    return True
+
 
 def proxenet_request_hook(rid, request, uri):
     return request
 
 def proxenet_response_hook(rid, response, uri):
-    patt = re.compile(r"([a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+)")
-    for email in patt.findall(response):
-        print "Found email in %d: %s" % (rid, email)
+    stream, body = decoded_streams.feed(rid, RESPONSE, response)
+    state = stream.states.get(__PLUGIN__, None)
+    if state is None:
+        if stream.message is None and stream.error is None:
+            return response
+        state = stream.states[__PLUGIN__] = MemoStream(__PLUGIN__, scanner.stream, bounded=stream.bounded)
+
+    found = state.feed(body, stream.complete) if body or stream.complete else []
+    if not found:
+        return response
+
+    host = urlparse.urlsplit(uri).netloc or uri
+    for finding in found:
+        if is_new(host, finding.value):
+            findings.report(__PLUGIN__, rid, uri, finding.kind, finding.value)
 
     return response
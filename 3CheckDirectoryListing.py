@@ -6,6 +6,7 @@ of a specific URL.
 """
 
 import urllib, urlparse, re
+from pimp import findings
 
 
 AUTHOR = "hugsy"
@@ -14,8 +15,8 @@ PLUGIN_NAME = "CheckDirectoryListing"
 ALREADY_VISITED_PATH = []
 
 
-def success(msg):
-    print("\x1b[4m\x1b[1m\x1b[95m" + msg + "\x1b[0m")
+def success(rid, path, kind):
+    findings.report(PLUGIN_NAME, rid, path, kind, path)
     return
 
 
@@ -36,7 +37,7 @@ def get_paths(uri):
     return urls
 
 
-def scan_dirlist(path):
+def scan_dirlist(rid, path):
     PATTERNS = ["Parent Directory", "Last modified", "Index Of",
                 "Description", "Name", "Size", "Apache/", "../"]
     match = 0
@@ -53,9 +54,9 @@ def scan_dirlist(path):
         ratio = float(match)/len(PATTERNS)
 
         if (success_ratio/2) < ratio < success_ratio:
-            success( "[+] Directory listing on '%s' (LIKELY)" % path )
+            success( rid, path, "directory_listing_likely" )
         elif ratio >= success_ratio:
-            success( "[+] Directory listing on '%s'" % path )
+            success( rid, path, "directory_listing" )
 
     except Exception as e:
         pass
@@ -70,7 +71,7 @@ def proxenet_request_hook(request_id, request, uri):
         if url in ALREADY_VISITED_PATH:
             continue
 
-        scan_dirlist(url)
+        scan_dirlist(request_id, url)
         ALREADY_VISITED_PATH.append( url )
 
     return request
@@ -8,6 +8,7 @@ A small cache is implemented never to retest a same host (ip:port) twice.
 """
 
 import sys, subprocess, urllib, urlparse, inspect
+from pimp import findings
 
 AUTHOR = "hugsy"
 PLUGIN_NAME = "CVE-2012-1823"
@@ -52,7 +53,7 @@ def proxenet_request_hook(request_id, request, uri):
 
     retcode = p.wait()
     if retcode :
-        print("\x1b[4m\x1b[1m\x1b[95m{} is vulnerable to CVE-2012-1823!!\x1b[0m".format(uri))
+        findings.report(PLUGIN_NAME, request_id, uri, "CVE-2012-1823", get_base_url(uri))
 
     ALREADY_TESTED_HOSTS.append( get_base_url(uri) )
     return request
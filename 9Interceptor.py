@@ -22,6 +22,7 @@ Requires:
 
 import sys, os, urlparse, json, subprocess, inspect, copy
 import socket, base64, pprint, urllib, ConfigParser
+from pimp import parse_query, Verdicts, PASS_THROUGH, REQUEST, RESPONSE
 
 try:
     from lxml import etree
@@ -38,6 +39,7 @@ AUTHOR      = "hugsy"
 CRLF = "\r\n"
 CONFIG_FILE = os.getenv("HOME") + "/.proxenet.ini"
 config = None
+verdicts = Verdicts()
 
 WINDOW_SIZE = (960, 600)
 
@@ -182,10 +184,8 @@ class AspViewstateInterceptView(QWidget):
 
     def getViewState(self):
         body = self.parent.parent.body
-        args = [x.split("=") for x in body.split("&")]
-        for k,v in args:
-            if k=="__VIEWSTATE": return urllib.unquote(v)
-        return None
+        values = parse_query(body).get("__VIEWSTATE", None)
+        return values[0] if values else None
 
     def setTabLayout(self):
         vs = self.viewstate.vs_arr
@@ -926,8 +926,27 @@ def call_gui(_type, rid, buffer, uri):
     return data
 
 
+def is_passed_through(rid, direction, data, uri):
+    """
+    Blacklisted extensions are checked once per request id: the request and all the
+    fragments of its response are then passed through without spawning the GUI.
+    """
+    if verdicts.lookup(rid, direction, data) == PASS_THROUGH:
+        return True
+
+    init_config()
+    if is_blacklisted_extension(uri):
+        verdicts.set(rid, direction, PASS_THROUGH, data)
+        if direction == REQUEST:
+            verdicts.set(rid, RESPONSE, PASS_THROUGH)
+        return True
+    return False
+
+
 def proxenet_request_hook(request_id, request, uri):
     if __name__.endswith("InterceptorResponse") or __name__.endswith("Interceptor"):
+        if is_passed_through(request_id, REQUEST, request, uri):
+            return request
         return call_gui("req", request_id, request, uri)
     else:
         return request
@@ -935,6 +954,8 @@ def proxenet_request_hook(request_id, request, uri):
 
 def proxenet_response_hook(response_id, response, uri):
     if __name__.endswith("InterceptorResponse") or __name__.endswith("Interceptor"):
+        if is_passed_through(response_id, RESPONSE, response, uri):
+            return response
         return call_gui("res", response_id, response, uri)
     else:
         return response
